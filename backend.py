@@ -0,0 +1,416 @@
+import collections
+import errno
+import hashlib
+import os
+import random
+import shutil
+import threading
+import time
+
+from utils import *
+from throttle import Throttle
+
+# A backend is one storage root (usually a CloudFusion mount). All of the
+# piece I/O in unified.py goes through one of these, with paths given
+# RELATIVE to the root's .ufs directory, so that the same code can run
+# against a plain local directory or a simulated cloud drive.
+class LocalBackend(object):
+    def __init__(self, root, weight=None, ops=None, rate=None):
+        self.root = root
+        # Requests to this root are kept under ops/sec and rate bytes/sec
+        self.throttle = Throttle(root, ops, rate)
+        # Configured share of the stripe, or None to go by throughput
+        self.configured_weight = weight
+        # EWMA of observed transfer rate in bytes/sec, None until measured
+        self.throughput = None
+
+    def __repr__(self):
+        return self.root
+
+    def path(self, relpath=None):
+        return ufspath(self.root, relpath)
+
+    # Store-wide metadata (journal, manifests, ...) lives next to .ufs so
+    # that it never shows up in the mirrored tree.
+    def meta_path(self, name=None):
+        if name is None:
+            return self.root + '/.ufs-meta'
+        return self.root + '/.ufs-meta/' + name
+
+    # Make sure the root is a directory with .ufs and .ufs-meta
+    # directories in it.
+    def ensure(self):
+        if not os.path.isdir(self.root):
+            error(self.root + ' is not a directory')
+        children = os.listdir(self.root)
+        if '.ufs' not in children:
+            os.mkdir(self.path())
+        if '.ufs-meta' not in children:
+            os.mkdir(self.meta_path())
+        if not os.path.isdir(self.meta_path('staging')):
+            os.mkdir(self.meta_path('staging'))
+
+    def listdir(self, relpath=None):
+        return os.listdir(self.path(relpath))
+
+    def isfile(self, relpath):
+        return os.path.isfile(self.path(relpath))
+
+    def isdir(self, relpath):
+        return os.path.isdir(self.path(relpath))
+
+    def getsize(self, relpath):
+        return os.path.getsize(self.path(relpath))
+
+    def mkdir(self, relpath):
+        os.mkdir(self.path(relpath))
+
+    def remove(self, relpath):
+        os.remove(self.path(relpath))
+
+    def rmdir(self, relpath):
+        os.rmdir(self.path(relpath))
+
+    def rename(self, old, new):
+        os.rename(self.path(old), self.path(new))
+
+    # Delete everything under .ufs and start over with an empty directory.
+    def reset(self):
+        shutil.rmtree(self.path())
+        os.mkdir(self.path())
+
+    def open(self, relpath, mode='r'):
+        return open(self.path(relpath), mode)
+
+    def read(self, relpath):
+        start = time.time()
+        with self.open(relpath, 'r') as handle:
+            data = handle.read()
+        self.measure(len(data), time.time() - start)
+        return data
+
+    def write(self, relpath, data):
+        start = time.time()
+        with self.open(relpath, 'w') as handle:
+            handle.write(data)
+        self.measure(len(data), time.time() - start)
+
+    # New pieces are written to .ufs-meta/staging first, out of the
+    # mirrored tree, and only moved into place once every root has all
+    # of them (see apply_journal in unified.py).
+    def staged_path(self, relpath):
+        if isinstance(relpath, unicode):
+            relpath = relpath.encode('utf-8')
+        return self.meta_path('staging/' + hashlib.md5(relpath).hexdigest())
+
+    def open_staged(self, relpath):
+        return open(self.staged_path(relpath), 'w')
+
+    def write_staged(self, relpath, data):
+        start = time.time()
+        with self.open_staged(relpath) as handle:
+            handle.write(data)
+        self.measure(len(data), time.time() - start)
+
+    # Move the staged copy of relpath into place. Returns False if there
+    # is none, because it was moved already.
+    def promote(self, relpath):
+        try:
+            os.rename(self.staged_path(relpath), self.path(relpath))
+        except OSError as e:
+            if e.errno != errno.ENOENT or os.path.exists(self.staged_path(relpath)):
+                raise
+            return False
+        return True
+
+    # Drop whatever is staged, left over from flushes that never got
+    # to move it into place
+    def clear_staged(self):
+        for name in os.listdir(self.meta_path('staging')):
+            os.remove(self.meta_path('staging/' + name))
+
+    # Fold one transfer into the throughput estimate. Small transfers
+    # are all latency and say nothing about bandwidth.
+    def measure(self, nbytes, seconds, alpha=0.2):
+        if nbytes < 64 * 1024 or seconds <= 0:
+            return
+        rate = nbytes / seconds
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput = (1 - alpha) * self.throughput + alpha * rate
+
+    # Relative share of stripe data this backend should get: the
+    # configured weight if there is one, otherwise its measured
+    # throughput (None if it has not been measured yet).
+    def weight(self):
+        if self.configured_weight is not None:
+            return self.configured_weight
+        return self.throughput
+
+    # All pieces stored for the logical file relpath, i.e. every
+    # 'dir/foo.X.Y' for 'dir/foo'.
+    def pieces(self, relpath):
+        dirname, basename = os.path.split(relpath)
+        if dirname and not self.isdir(dirname):
+            return []
+        found = []
+        for child in self.listdir(dirname or None):
+            if is_piece_name(child, basename):
+                found.append(os.path.join(dirname, child))
+        return found
+
+    # Returns None if the metadata file does not exist.
+    def read_meta(self, name):
+        try:
+            with open(self.meta_path(name), 'r') as handle:
+                return handle.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    # length bytes at offset of a metadata file
+    def read_meta_range(self, name, offset, length):
+        start = time.time()
+        with open(self.meta_path(name), 'r') as handle:
+            handle.seek(offset)
+            data = handle.read(length)
+        self.measure(len(data), time.time() - start)
+        return data
+
+    # Replace a metadata file atomically.
+    def write_meta(self, name, data):
+        temp = self.meta_path(name + '.tmp')
+        if not os.path.isdir(os.path.dirname(temp)):
+            os.makedirs(os.path.dirname(temp))
+        with open(temp, 'w') as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.rename(temp, self.meta_path(name))
+
+    def remove_meta(self, name):
+        try:
+            os.remove(self.meta_path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    # Append to a metadata file and make it durable before returning.
+    def append_meta(self, name, data):
+        with open(self.meta_path(name), 'a') as handle:
+            handle.write(data)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+    # List one directory (a full path below the root) as DirEntries
+    def list_dir(self, path):
+        return scan_dir(path)
+
+    # utils.walk over .ufs, with every listing going through the backend
+    def walk(self, prefetch=0, with_stat=False):
+        return walk(self.path(), prefetch, with_stat, self.list_dir)
+
+    # utils.traverse over .ufs, with every listing going through the backend
+    def traverse(self, on_file, on_dir, prefetch=0):
+        traverse(self.path(), on_file, on_dir, prefetch, self.list_dir)
+
+# A local directory that behaves like a cloud drive: every operation pays
+# a round trip of `latency` seconds (plus up to `jitter` more), transfers
+# share a link of `bandwidth` bytes/sec, and each operation fails with EIO
+# with probability `failures`.
+class SimulatedBackend(LocalBackend):
+    def __init__(self, root, latency=0.0, bandwidth=None, jitter=0.0, failures=0.0, quota=None,
+                 weight=None, ops=None, rate=None):
+        LocalBackend.__init__(self, root, weight, ops, rate)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.jitter = jitter
+        self.failures = failures
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.busy_until = 0.0
+        # When the requests of the last second came in, for the quota
+        self.recent = collections.deque()
+
+    def __repr__(self):
+        return 'sim:' + self.root
+
+    # Pay for one operation that moves nbytes over the link.
+    def charge(self, nbytes=0):
+        if self.quota:
+            # Like a provider answering 429 past its rate limit
+            with self.lock:
+                now = time.time()
+                while self.recent and self.recent[0] <= now - 1:
+                    self.recent.popleft()
+                self.recent.append(now)
+                over = len(self.recent) > self.quota
+            if over:
+                raise IOError(errno.EIO, 'simulated rate limit on ' + self.root)
+
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+
+        if self.bandwidth and nbytes:
+            # Transfers queue up behind each other on the shared link,
+            # so the cap holds no matter how many threads are using it.
+            with self.lock:
+                now = time.time()
+                start = max(now, self.busy_until)
+                self.busy_until = start + float(nbytes) / self.bandwidth
+                delay += self.busy_until - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.failures and random.random() < self.failures:
+            raise IOError(errno.EIO, 'simulated failure on ' + self.root)
+
+    def listdir(self, relpath=None):
+        self.charge()
+        return LocalBackend.listdir(self, relpath)
+
+    def list_dir(self, path):
+        self.charge()
+        return LocalBackend.list_dir(self, path)
+
+    def isfile(self, relpath):
+        self.charge()
+        return LocalBackend.isfile(self, relpath)
+
+    def isdir(self, relpath):
+        self.charge()
+        return LocalBackend.isdir(self, relpath)
+
+    def getsize(self, relpath):
+        self.charge()
+        return LocalBackend.getsize(self, relpath)
+
+    def mkdir(self, relpath):
+        self.charge()
+        LocalBackend.mkdir(self, relpath)
+
+    def remove(self, relpath):
+        self.charge()
+        LocalBackend.remove(self, relpath)
+
+    def rmdir(self, relpath):
+        self.charge()
+        LocalBackend.rmdir(self, relpath)
+
+    def rename(self, old, new):
+        self.charge()
+        LocalBackend.rename(self, old, new)
+
+    def reset(self):
+        self.charge()
+        LocalBackend.reset(self)
+
+    def open(self, relpath, mode='r'):
+        self.charge()
+        return SimulatedFile(self, LocalBackend.open(self, relpath, mode))
+
+    def open_staged(self, relpath):
+        self.charge()
+        return SimulatedFile(self, LocalBackend.open_staged(self, relpath))
+
+    def promote(self, relpath):
+        self.charge()
+        return LocalBackend.promote(self, relpath)
+
+    def clear_staged(self):
+        self.charge()
+        LocalBackend.clear_staged(self)
+
+    def read_meta(self, name):
+        data = LocalBackend.read_meta(self, name)
+        self.charge(len(data or ''))
+        return data
+
+    def read_meta_range(self, name, offset, length):
+        self.charge(length)
+        return LocalBackend.read_meta_range(self, name, offset, length)
+
+    def write_meta(self, name, data):
+        self.charge(len(data))
+        LocalBackend.write_meta(self, name, data)
+
+    def remove_meta(self, name):
+        self.charge()
+        LocalBackend.remove_meta(self, name)
+
+    def append_meta(self, name, data):
+        self.charge(len(data))
+        LocalBackend.append_meta(self, name, data)
+
+# File handle wrapper that charges the backend for every byte moved.
+class SimulatedFile(object):
+    def __init__(self, backend, handle):
+        self.backend = backend
+        self.handle = handle
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.backend.charge(len(data))
+        return data
+
+    def write(self, data):
+        self.backend.charge(len(data))
+        self.handle.write(data)
+
+    def close(self):
+        self.handle.close()
+
+# parse_size('4M') = 4194304
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+# Build a backend from a command line root.
+#
+# ex:
+#
+# /mnt/dropbox
+# /mnt/dropbox?weight=3
+# /mnt/dropbox?ops=10&rate=2M
+# sim:/tmp/root1?latency=0.05&jitter=0.02&bandwidth=2M&failures=0.001&quota=20
+def backend_from_spec(spec):
+    simulated = spec.startswith('sim:')
+    if simulated:
+        spec = spec[len('sim:'):]
+
+    root, _, query = spec.partition('?')
+    options = {}
+    for option in query.split('&'):
+        if not option:
+            continue
+        key, _, value = option.partition('=')
+        if key in ('weight', 'ops'):
+            options[key] = float(value)
+        elif key == 'rate':
+            options[key] = parse_size(value)
+        elif simulated and key in ('latency', 'jitter', 'failures', 'quota'):
+            options[key] = float(value)
+        elif simulated and key == 'bandwidth':
+            options[key] = parse_size(value)
+        else:
+            error('Unrecognized backend option: ' + key)
+
+    if simulated:
+        return SimulatedBackend(root, **options)
+    return LocalBackend(root, **options)
@@ -0,0 +1,229 @@
+import collections
+import heapq
+import itertools
+import threading
+
+from utils import *
+
+# Bookkeeping for the local copy of the store: which files are resident,
+# how much of them, in what order they were last used, and which have
+# been evicted (their local copy is only a placeholder and has to be
+# fetched back from the roots). Files stored in blocks can be partly
+# resident: only the blocks that were read are fetched back. The cache
+# never touches the files itself; the filesystem asks it for victims
+# once it is over capacity and evicts them.
+#
+# Pinned files (open, or dirty and not yet flushed to the roots) are
+# never handed out as victims.
+class LocalCache(object):
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        # path -> set of blocks still to fetch, None for all of the file
+        self.evicted = {}
+        self.pins = collections.defaultdict(int)
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def is_evicted(self, path):
+        with self.lock:
+            return path in self.evicted
+
+    def missing_blocks(self, path):
+        with self.lock:
+            return self.evicted.get(path)
+
+    # path was just used. Unless (some of) it is evicted, it is resident
+    # with size bytes.
+    def touch(self, path, size):
+        with self.lock:
+            if path in self.evicted:
+                size = self.entries.get(path, 0)
+            self.used -= self.entries.pop(path, 0)
+            self.entries[path] = size
+            self.used += size
+
+    # Blocks of path were fetched back, size bytes of it are now resident.
+    # missing is the set of blocks that were still to fetch before.
+    def fill(self, path, blocks, missing, size):
+        with self.lock:
+            self.used -= self.entries.pop(path, 0)
+            self.entries[path] = size
+            self.used += size
+            missing = missing - set(blocks)
+            if missing:
+                self.evicted[path] = missing
+            else:
+                self.evicted.pop(path, None)
+
+    # path, stored in total blocks, was truncated to count blocks: the
+    # blocks past its end are gone rather than still to fetch
+    def cut(self, path, count, total):
+        with self.lock:
+            if path not in self.evicted:
+                return
+            missing = self.evicted[path]
+            if missing is None:
+                missing = range(total)
+            missing = set(block for block in missing if block < count)
+            if missing:
+                self.evicted[path] = missing
+            else:
+                self.evicted.pop(path)
+
+    def has_room(self):
+        with self.lock:
+            return self.capacity is None or self.used < self.capacity
+
+    # Evicted paths at or below path
+    def evicted_under(self, path):
+        with self.lock:
+            return [p for p in self.evicted if p == path or p.startswith(path + '/')]
+
+    def evict(self, path):
+        with self.lock:
+            self.used -= self.entries.pop(path, 0)
+            self.evicted[path] = None
+
+    # evict(path), unless it is pinned: checked and marked at once, so
+    # that whatever pins it from here on finds it evicted. Returns
+    # whether it was.
+    def evict_unpinned(self, path):
+        with self.lock:
+            if path in self.pins:
+                return False
+            self.used -= self.entries.pop(path, 0)
+            self.evicted[path] = None
+            return True
+
+    def forget(self, path):
+        with self.lock:
+            self.used -= self.entries.pop(path, 0)
+            self.evicted.pop(path, None)
+            self.pins.pop(path, None)
+
+    def rename(self, old, new):
+        with self.lock:
+            for path in list(self.entries):
+                if path == old or path.startswith(old + '/'):
+                    self.entries[new + path[len(old):]] = self.entries.pop(path)
+            for path in list(self.pins):
+                if path == old or path.startswith(old + '/'):
+                    self.pins[new + path[len(old):]] = self.pins.pop(path)
+            for path in list(self.evicted):
+                if path == old or path.startswith(old + '/'):
+                    self.evicted[new + path[len(old):]] = self.evicted.pop(path)
+
+    def pin(self, path):
+        with self.lock:
+            self.pins[path] += 1
+
+    def unpin(self, path):
+        with self.lock:
+            self.pins[path] -= 1
+            if self.pins[path] <= 0:
+                del self.pins[path]
+
+    # pin(path) for the length of a with statement
+    def pinned(self, path):
+        return Pin(self, path)
+
+    # Least recently used files that can go to get back under capacity.
+    # is_clean(path) says whether path's contents are safely on the roots.
+    def victims(self, is_clean):
+        if self.capacity is None:
+            return []
+        with self.lock:
+            excess = self.used - self.capacity
+            found = []
+            for path, size in self.entries.items():
+                if excess <= 0:
+                    break
+                if path in self.pins or not is_clean(path):
+                    continue
+                found.append(path)
+                excess -= size
+            return found
+
+class Pin(object):
+    def __init__(self, cache, path):
+        self.cache = cache
+        self.path = path
+
+    def __enter__(self):
+        self.cache.pin(self.path)
+        return self
+
+    def __exit__(self, *args):
+        self.cache.unpin(self.path)
+
+# Fetches evicted files back in the background, most wanted first, on
+# `workers` threads. Paths that were just looked at (opened, stat'ed,
+# listed) jump the queue and are fetched right away; the rest are fetched
+# while the cache has room.
+class Hydrator(object):
+    URGENT = 0
+    IDLE = 1
+
+    # fetch(path) brings one path back, has_room() says whether the
+    # cache can take more
+    def __init__(self, fetch, has_room, workers=1):
+        self.fetch = fetch
+        self.has_room = has_room
+        self.workers = workers
+        self.heap = []
+        self.queued = {}
+        self.order = itertools.count()
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.threads = []
+
+    def add(self, path, priority=IDLE):
+        with self.cond:
+            if self.queued.get(path, priority + 1) <= priority:
+                return
+            self.queued[path] = priority
+            heapq.heappush(self.heap, (priority, next(self.order), path))
+            self.cond.notify()
+
+    # Move path to the front, if it is still waiting
+    def bump(self, path):
+        if path in self.queued:
+            self.add(path, self.URGENT)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def _next(self):
+        with self.cond:
+            while not self.stopping:
+                if self.heap and (self.heap[0][0] == self.URGENT or self.has_room()):
+                    priority, order, path = heapq.heappop(self.heap)
+                    if self.queued.get(path) == priority:
+                        del self.queued[path]
+                        return path
+                    continue
+                # Room may open up without anyone telling us
+                self.cond.wait(1.0)
+            return None
+
+    def _run(self):
+        while True:
+            path = self._next()
+            if path is None:
+                return
+            try:
+                self.fetch(path)
+            except (IOError, OSError) as e:
+                log('fetching %s failed: %s' % (path, e))
@@ -0,0 +1,45 @@
+import os
+import sys
+import threading
+import time
+
+from utils import *
+
+# Usage: debug-stress.py <file on a mounted ucs> [max clients]
+#
+# Reads the file with 1, 2, 4, ... concurrent clients doing positional
+# reads and prints the aggregate throughput for each, so it is easy to
+# see whether concurrent readers scale or serialize.
+
+block_size = 64 * 1024
+
+def client(path, stop, counts, i):
+    fd = os.open(path, os.O_RDONLY)
+    size = os.fstat(fd).st_size
+    offset = (i * block_size) % max(size, 1)
+    while not stop.is_set():
+        data = pread(fd, block_size, offset)
+        counts[i] += len(data)
+        offset = offset + block_size if len(data) == block_size else 0
+    os.close(fd)
+
+def run(path, clients, seconds=5):
+    stop = threading.Event()
+    counts = [0] * clients
+    threads = [threading.Thread(target=client, args=(path, stop, counts, i))
+               for i in range(clients)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / float(seconds)
+
+if __name__ == '__main__':
+    max_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    clients = 1
+    while clients <= max_clients:
+        rate = run(sys.argv[1], clients)
+        print('%3d clients: %8.1f MB/s' % (clients, rate / (1 << 20)))
+        clients *= 2
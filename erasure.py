@@ -0,0 +1,117 @@
+from utils import *
+
+# Reed-Solomon erasure coding over GF(2^8): k data shards plus m parity
+# shards, any k of which are enough to get the data back.
+#
+# Multiplying a whole shard by a constant is a str.translate with a
+# 256-byte table and adding shards is xor_bytes (vectorized by numpy
+# when it is installed), so the per-byte work all happens in C.
+
+# x^8 + x^4 + x^3 + x^2 + 1
+POLYNOMIAL = 0x11d
+
+EXP = [0] * 512
+LOG = [0] * 256
+
+def _init_tables():
+    x = 1
+    for i in range(255):
+        EXP[i] = x
+        LOG[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= POLYNOMIAL
+    for i in range(255, 512):
+        EXP[i] = EXP[i - 255]
+
+_init_tables()
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return EXP[LOG[a] + LOG[b]]
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(2^8)')
+    return EXP[255 - LOG[a]]
+
+_translate_tables = {}
+
+# translate table that multiplies every byte by c
+def mul_table(c):
+    table = _translate_tables.get(c)
+    if table is None:
+        table = ''.join(chr(gf_mul(c, b)) for b in range(256))
+        _translate_tables[c] = table
+    return table
+
+# sum over i of coefficients[i] * shards[i], all shards the same length
+def combine(coefficients, shards):
+    products = []
+    for c, shard in zip(coefficients, shards):
+        if c == 1:
+            products.append(shard)
+        elif c:
+            products.append(shard.translate(mul_table(c)))
+    if not products:
+        return '\0' * len(shards[0])
+    return xor_bytes(*products)
+
+# Invert a square matrix over GF(2^8) by Gauss-Jordan elimination.
+def invert_matrix(matrix):
+    n = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next((r for r in range(col, n) if rows[r][col]), None)
+        if pivot is None:
+            raise ValueError('singular matrix')
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+
+        inv = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(inv, x) for x in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [x ^ gf_mul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
+
+class ReedSolomon(object):
+    def __init__(self, k, m):
+        if k < 1 or m < 0 or k + m > 256:
+            raise ValueError('bad erasure code: %d+%d' % (k, m))
+        self.k = k
+        self.m = m
+        # Systematic code: the data shards are stored as they are and
+        # parity i uses row i of a Cauchy matrix, so that every k x k
+        # submatrix of the generator is invertible.
+        self.parity_rows = [[gf_inv((k + i) ^ j) for j in range(k)] for i in range(m)]
+
+    # Generator row for shard index (0..k-1 data, k..k+m-1 parity)
+    def row(self, index):
+        if index < self.k:
+            return [int(j == index) for j in range(self.k)]
+        return self.parity_rows[index - self.k]
+
+    # k equal-length data shards -> m parity shards
+    def encode(self, shards):
+        return [combine(row, shards) for row in self.parity_rows]
+
+    # {index: shard} with at least k entries -> the k data shards
+    def decode(self, available):
+        if len(available) < self.k:
+            raise ValueError('need %d shards, have %d' % (self.k, len(available)))
+        if all(i in available for i in range(self.k)):
+            return [available[i] for i in range(self.k)]
+
+        indices = sorted(available)[:self.k]
+        shards = [available[i] for i in indices]
+        decoder = invert_matrix([self.row(i) for i in indices])
+
+        data = []
+        for j in range(self.k):
+            if j in available:
+                data.append(available[j])
+            else:
+                data.append(combine(decoder[j], shards))
+        return data
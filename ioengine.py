@@ -0,0 +1,118 @@
+import Queue
+import threading
+
+from utils import *
+
+# Runs blocking backend calls (piece reads and writes, listings, mkdirs,
+# metadata writes) on worker threads, so that many of them are in flight
+# at once instead of one round trip after another. Every root has its
+# own queue and its own workers, per_root of them, which caps how many
+# requests one root gets at a time and keeps a slow root from holding up
+# the others. What the data of a request takes up is reserved by the
+# caller from the memory budget (see memory.py) and handed over with the
+# request, which gives it back once done.
+#
+# Every task runs through its root's throttle (see throttle.py), which
+# keeps the root under its rate limits and retries what the provider
+# turned down; tasks that are not safe to run twice are submitted with
+# retry=False.
+#
+# Tasks must not wait on other tasks, or a root's workers could all end
+# up waiting on each other.
+class IOEngine(object):
+    def __init__(self, per_root, memory):
+        self.per_root = per_root
+        self.memory = memory
+        self.queues = {}
+        self.workers = []
+        self.lock = threading.Lock()
+
+    # Run fn(*args) on one of backend's workers; size is how many bytes
+    # it moves, if known, and hold how much reserved memory comes with it.
+    # Returns a Task to wait on, and calls done(task) from the worker
+    # once it is finished if given.
+    def submit(self, backend, fn, *args, **kwargs):
+        size = kwargs.pop('size', 0)
+        retry = kwargs.pop('retry', True)
+        done = kwargs.pop('done', None)
+        task = Task(backend.throttle, fn, args, size, retry, done)
+        task.held = kwargs.pop('hold', 0)
+        self._queue(backend).put(task)
+        return task
+
+    def _queue(self, backend):
+        with self.lock:
+            queue = self.queues.get(backend)
+            if queue is None:
+                queue = self.queues[backend] = Queue.Queue()
+                for i in range(self.per_root):
+                    worker = threading.Thread(target=self._work, args=(queue,))
+                    worker.daemon = True
+                    worker.start()
+                    self.workers.append(worker)
+            return queue
+
+    def _work(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            task.run()
+            self.memory.release(task.held)
+
+    # Run fn(backend) on every backend at once. Returns the results in
+    # the order of backends.
+    def each(self, backends, fn, retry=True):
+        return wait([self.submit(backend, fn, backend, retry=retry) for backend in backends])
+
+    def close(self):
+        with self.lock:
+            for queue in self.queues.values():
+                for i in range(self.per_root):
+                    queue.put(None)
+            self.queues = {}
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.join()
+
+class Task(object):
+    def __init__(self, throttle, fn, args, size, retry, callback=None):
+        self.throttle = throttle
+        self.fn = fn
+        self.args = args
+        self.size = size
+        self.retry = retry
+        self.callback = callback
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.throttle.call(self.fn, self.args, self.size, self.retry)
+        except Exception as e:
+            self.error = e
+        # Let go of the data as soon as it is written
+        self.fn = self.args = None
+        self.done.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+# Wait for all of tasks, then return their results, or raise the first
+# error one of them hit.
+def wait(tasks):
+    for task in tasks:
+        task.done.wait()
+    return [task.result() for task in tasks]
+
+# Run fn(backend) for every backend, through io if there is one
+def each(io, backends, fn, retry=True):
+    if io is None:
+        return [fn(backend) for backend in backends]
+    return io.each(backends, fn, retry)
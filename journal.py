@@ -0,0 +1,119 @@
+import json
+import threading
+import time
+
+from utils import *
+from ioengine import each
+
+# Write-ahead log of metadata operations, replicated to every backend's
+# .ufs-meta/journal. Each record is one JSON line:
+#
+# {"seq": 12, "op": "rename", "args": ["a/foo", "a/bar"]}
+#
+# .ufs-meta/checkpoint holds the seq of the last record that has been
+# applied to the roots; anything after it is the tail that still has to
+# be replayed (by destroy normally, or by init after a crash).
+class Journal(object):
+    def __init__(self, backends, io=None):
+        self.backends = backends
+        self.io = io
+        self.seq = 0
+        self.applied = 0
+        self.records = []
+
+    # Read the journal state back from the roots. Every root gets every
+    # record, but a crash can leave some roots behind; the longest
+    # journal wins.
+    def load(self):
+        journals = each(self.io, self.backends,
+                        lambda backend: (backend.read_meta('journal') or '', backend.read_meta('checkpoint')))
+        records = []
+        for data, checkpoint in journals:
+            found = [json.loads(line) for line in data.splitlines() if line]
+            if len(found) > len(records):
+                records = found
+
+        self.applied = max([int(checkpoint or 0) for data, checkpoint in journals] or [0])
+        self.seq = records[-1]['seq'] if records else self.applied
+        self.records = [r for r in records if r['seq'] > self.applied]
+        return self.records
+
+    def append(self, op, *args):
+        self.seq += 1
+        record = {'seq': self.seq, 'op': op, 'args': list(args)}
+        line = json.dumps(record) + '\n'
+        # Appending twice would duplicate the record
+        each(self.io, self.backends, lambda backend: backend.append_meta('journal', line), retry=False)
+        self.records.append(record)
+        return record
+
+    # Records that have not reached the roots yet.
+    def pending(self):
+        return list(self.records)
+
+    # Everything up to seq is on the roots: move the checkpoint and drop
+    # the applied part of the journal.
+    def checkpoint(self, seq):
+        self.records = [r for r in self.records if r['seq'] > seq]
+        self.applied = seq
+        data = ''.join(json.dumps(r) + '\n' for r in self.records)
+        def write(backend):
+            backend.write_meta('checkpoint', str(seq))
+            backend.write_meta('journal', data)
+        each(self.io, self.backends, write)
+
+# Batches commits asked for at about the same time. The first caller
+# waits `window` seconds for others to join, then runs one commit for
+# all of them; whoever asks while a commit is running gets the next one,
+# since the running commit may have missed their changes.
+class GroupCommit(object):
+    def __init__(self, commit, window):
+        self.commit = commit
+        self.window = window
+        self.cond = threading.Condition()
+        self.started = 0
+        self.finished = 0
+        self.running = False
+        # batch -> callers waiting for it, and what it raised
+        self.waiting = {}
+        self.errors = {}
+
+    # Returns once a commit that started after the call has finished, and
+    # raises what that commit raised.
+    def wait(self):
+        with self.cond:
+            batch = self.started + 1
+            self.waiting[batch] = self.waiting.get(batch, 0) + 1
+            while self.finished < batch:
+                if self.running:
+                    self.cond.wait()
+                    continue
+                # Lead this batch
+                self.running = True
+                self.cond.release()
+                try:
+                    time.sleep(self.window)
+                finally:
+                    self.cond.acquire()
+                self.started = batch
+                self.cond.release()
+                error = None
+                try:
+                    self.commit()
+                except Exception as e:
+                    error = e
+                finally:
+                    self.cond.acquire()
+                    self.running = False
+                    self.finished = batch
+                    if error is not None:
+                        self.errors[batch] = error
+                    self.cond.notify_all()
+
+            error = self.errors.get(batch)
+            self.waiting[batch] -= 1
+            if not self.waiting[batch]:
+                del self.waiting[batch]
+                self.errors.pop(batch, None)
+        if error is not None:
+            raise error
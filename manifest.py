@@ -0,0 +1,116 @@
+import hashlib
+import json
+import threading
+
+from utils import *
+from ioengine import each
+
+# Per-file layout records that the piece names alone cannot carry (how a
+# file was striped, ...), replicated to every root. Like the Merkle
+# nodes, the manifest is sharded by directory: .ufs-meta/manifest/<hash>
+# holds {name: record} for the files of one directory, so changing a
+# file only rewrites its own directory's shard.
+
+def shard_name(dirpath):
+    return 'manifest/' + hashlib.md5(dirpath).hexdigest()
+
+class Manifest(object):
+    def __init__(self, backends, io=None):
+        self.backends = backends
+        self.io = io
+        self.dirs = {}
+        self.dirty = set()
+        self.lock = threading.RLock()
+
+    def _load(self, dirpath):
+        if dirpath not in self.dirs:
+            records = {}
+            for backend in self.backends:
+                try:
+                    data = backend.read_meta(shard_name(dirpath))
+                except (IOError, OSError):
+                    continue
+                if data is not None:
+                    records = json.loads(data)
+                    break
+            self.dirs[dirpath] = records
+        return self.dirs[dirpath]
+
+    def get(self, relpath):
+        dirpath, _, name = relpath.rpartition('/')
+        with self.lock:
+            return self._load(dirpath).get(name)
+
+    # {name: record} for the files of one directory
+    def records(self, dirpath):
+        with self.lock:
+            return dict(self._load(dirpath))
+
+    # The shards read so far, {dirpath: records}, and a way to start
+    # from ones saved before (see metacache.py)
+    def loaded(self):
+        with self.lock:
+            return dict((dirpath, dict(records)) for dirpath, records in self.dirs.items())
+
+    def preload(self, dirs):
+        with self.lock:
+            self.dirs.update(dirs)
+
+    def set(self, relpath, record):
+        dirpath, _, name = relpath.rpartition('/')
+        with self.lock:
+            self._load(dirpath)[name] = record
+            self.dirty.add(dirpath)
+
+    def remove(self, relpath):
+        dirpath, _, name = relpath.rpartition('/')
+        with self.lock:
+            if self._load(dirpath).pop(name, None) is not None:
+                self.dirty.add(dirpath)
+
+    # Move the record for a file, or the shards of a directory and all
+    # of subdirs (the directories below it) when old is a directory.
+    def rename(self, old, new, subdirs=()):
+        with self.lock:
+            record = self.get(old)
+            if record is not None:
+                self.remove(old)
+                self.set(new, record)
+
+            for dirpath in subdirs:
+                if dirpath != old and not dirpath.startswith(old + '/'):
+                    continue
+                if not self._load(dirpath):
+                    # Nothing to move (or moved already, when a rename is
+                    # replayed)
+                    continue
+                moved = new + dirpath[len(old):]
+                self.dirs[moved] = self._load(dirpath)
+                self.dirs[dirpath] = {}
+                self.dirty.update([dirpath, moved])
+
+    # The changed shards as save() would write them, {dirpath: records},
+    # and a way to take them back as changed (see apply_journal)
+    def changes(self):
+        with self.lock:
+            return dict((dirpath, self.dirs[dirpath]) for dirpath in self.dirty)
+
+    def redo(self, shards):
+        with self.lock:
+            for dirpath, records in shards.items():
+                self.dirs[dirpath] = records
+                self.dirty.add(dirpath)
+
+    # Write the changed shards to every root.
+    def save(self):
+        with self.lock:
+            shards = [(shard_name(dirpath), json.dumps(self.dirs[dirpath]) if self.dirs[dirpath] else None)
+                      for dirpath in self.dirty]
+            def write(backend):
+                for name, data in shards:
+                    if data is not None:
+                        backend.write_meta(name, data)
+                    else:
+                        backend.remove_meta(name)
+            each(self.io, self.backends, write)
+            self.dirty.clear()
@@ -0,0 +1,88 @@
+import threading
+
+from utils import *
+
+# One account of the memory the mount holds in buffers: write buffers,
+# blocks being encoded or rebuilt, pieces on their way to the roots,
+# segments being packed. Whoever is about to hold data reserves it first
+# and gives it back when done; once the limit is reached reserve blocks,
+# so producers slow down to the pace of whatever frees memory (uploads
+# finishing, mostly) instead of growing without bound.
+#
+# To keep that from deadlocking:
+# - a thread never waits in reserve while it holds a reservation of its
+#   own (take what is needed at once, or hand it over to the task that
+#   will free it);
+# - buffers that are only given back at their owner's pace (write
+#   buffers) use try_reserve and get at most WRITE_SHARE of the limit;
+# - no reservation is bigger than LARGEST of the limit, so one can always
+#   be met once the transient ones are back.
+WRITE_SHARE = 0.5
+LARGEST = 0.25
+
+class MemoryBudget(object):
+    # limit in bytes, None for no limit
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    # Wait until n more bytes fit, and take them. Returns how many were
+    # taken, which is what to release.
+    def reserve(self, n):
+        if self.limit is not None:
+            n = min(n, int(self.limit * LARGEST))
+        with self.cond:
+            while self.limit is not None and self.used and self.used + n > self.limit:
+                self.cond.wait()
+            self.used += n
+        return n
+
+    # Take n bytes if they fit in share of the limit right now
+    def try_reserve(self, n, share=1.0):
+        with self.cond:
+            if self.limit is not None and self.used + n > self.limit * share:
+                return False
+            self.used += n
+            return True
+
+    # Take n bytes whether they fit or not, for data that is already
+    # there and has to be counted
+    def force(self, n):
+        with self.cond:
+            self.used += n
+
+    def release(self, n):
+        if not n:
+            return
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+    # reserve(n) as a Reservation, to use in a with statement
+    def hold(self, n):
+        return Reservation(self, self.reserve(n))
+
+# Reserved memory, released when the with statement is left. Parts of it
+# can be handed over to whoever takes over the data (an upload, say),
+# who then releases that part.
+class Reservation(object):
+    def __init__(self, budget, size):
+        self.budget = budget
+        self.left = size
+
+    # Hand over up to n bytes; returns how many
+    def take(self, n):
+        n = min(n, self.left)
+        self.left -= n
+        return n
+
+    def release(self):
+        self.budget.release(self.left)
+        self.left = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
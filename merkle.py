@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+
+from utils import *
+from ioengine import each
+
+# Merkle hashes of the directory structure. Each directory is a node
+# whose entries map child names to '' for files and to the child's hash
+# for directories; a node's hash covers its entries, so the root hash
+# covers the whole tree.
+#
+# Every root stores one small file per directory under
+# .ufs-meta/merkle/, so two roots can be compared by reading their root
+# nodes and descending only where the hashes differ.
+
+def node_name(dirpath):
+    return 'merkle/' + hashlib.md5(dirpath).hexdigest()
+
+def hash_entries(entries):
+    h = hashlib.sha1()
+    for name in sorted(entries):
+        h.update('%s\0%s\0' % (name, entries[name]))
+    return h.hexdigest()
+
+# parent_dir('a/b/c') = 'a/b', parent_dir('a') = ''
+def parent_dir(relpath):
+    return relpath.rpartition('/')[0]
+
+def join_path(dirpath, name):
+    return dirpath + '/' + name if dirpath else name
+
+# Read one stored node from a backend, or None if it has none.
+def load_node(backend, dirpath):
+    data = backend.read_meta(node_name(dirpath))
+    if data is None:
+        return None
+    return json.loads(data)
+
+class MerkleTree(object):
+    # top is the local directory the tree describes; it is only needed
+    # for update(), trees of backends are built with scan().
+    def __init__(self, top=None):
+        self.top = top
+        self.nodes = {}
+
+    def root_hash(self):
+        return self.nodes['']['hash']
+
+    def _full_path(self, relpath):
+        return join_path(self.top, relpath)
+
+    # Hash the subtree at dirpath from scratch.
+    def _build(self, dirpath):
+        subtree = MerkleTree().scan(walk(self._full_path(dirpath)))
+        for path, node in subtree.nodes.items():
+            path = join_path(dirpath, path) if path else dirpath
+            node['path'] = path
+            self.nodes[path] = node
+
+    # Hash the whole tree from scratch, given a utils.walk over it.
+    def scan(self, entries):
+        children = {'': {}}
+        for relpath, entry, st in entries:
+            is_dir = entry.is_dir()
+            children[parent_dir(relpath)][relpath.rpartition('/')[2]] = is_dir
+            if is_dir:
+                children[relpath] = {}
+
+        self.nodes = {}
+        # Deepest first, so children are hashed before their parents
+        for dirpath in sorted(children, key=lambda p: -p.count('/') - bool(p)):
+            entries = {}
+            for name, is_dir in children[dirpath].items():
+                entries[name] = self.nodes[join_path(dirpath, name)]['hash'] if is_dir else ''
+            self.nodes[dirpath] = {'path': dirpath, 'entries': entries,
+                                   'hash': hash_entries(entries)}
+        return self
+
+    def _drop(self, dirpath):
+        removed = [path for path in self.nodes
+                   if path == dirpath or path.startswith(dirpath + '/')]
+        for path in removed:
+            del self.nodes[path]
+        return removed
+
+    # Re-hash the directories in dirpaths (and their ancestors) after
+    # they changed. Returns (changed, removed): the paths of the nodes
+    # that have to be rewritten and the ones that no longer exist.
+    def update(self, dirpaths):
+        todo = set()
+        for dirpath in dirpaths:
+            while True:
+                todo.add(dirpath)
+                if not dirpath:
+                    break
+                dirpath = parent_dir(dirpath)
+
+        changed = set()
+        removed = set()
+        # Deepest first, so children are current when parents are hashed
+        for dirpath in sorted(todo, key=lambda p: -p.count('/') - bool(p)):
+            if dirpath and not os.path.isdir(self._full_path(dirpath)):
+                removed.update(self._drop(dirpath))
+                continue
+
+            old = self.nodes.get(dirpath, {'entries': {}})['entries']
+            entries = {}
+            for entry in scan_dir(self._full_path(dirpath)):
+                child = entry.name
+                relpath = join_path(dirpath, child)
+                if not entry.is_dir():
+                    entries[child] = ''
+                    continue
+                if relpath not in self.nodes:
+                    # New (or renamed) directory: hash its whole subtree
+                    before = set(self.nodes)
+                    self._build(relpath)
+                    changed.update(set(self.nodes) - before)
+                entries[child] = self.nodes[relpath]['hash']
+
+            for child in old:
+                if old[child] and entries.get(child, '') == '':
+                    removed.update(self._drop(join_path(dirpath, child)))
+
+            self.nodes[dirpath] = {'path': dirpath, 'entries': entries,
+                                   'hash': hash_entries(entries)}
+            changed.add(dirpath)
+
+        return changed - removed, removed - changed
+
+    def save(self, backends, paths=None, removed=(), io=None):
+        if paths is None:
+            paths = self.nodes.keys()
+        nodes = [(node_name(path), json.dumps(self.nodes[path])) for path in paths]
+        def write(backend):
+            for name, data in nodes:
+                backend.write_meta(name, data)
+            for path in removed:
+                backend.remove_meta(node_name(path))
+        each(io, backends, write)
+
+# Compare the stored trees of all backends, starting at the roots and
+# descending only into directories whose hashes differ. Returns the
+# first directory whose entries do not match, or None if the trees are
+# the same.
+def find_mismatch(backends, dirpath=''):
+    nodes = [load_node(backend, dirpath) for backend in backends]
+    if None in nodes:
+        return dirpath
+    if len(set(node['hash'] for node in nodes)) == 1:
+        return None
+
+    names = [sorted((name, bool(h)) for name, h in node['entries'].items()) for node in nodes]
+    if any(n != names[0] for n in names[1:]):
+        return dirpath
+
+    for name, h in nodes[0]['entries'].items():
+        if h and any(node['entries'][name] != h for node in nodes[1:]):
+            mismatch = find_mismatch(backends, join_path(dirpath, name))
+            if mismatch is not None:
+                return mismatch
+
+    return dirpath
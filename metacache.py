@@ -0,0 +1,84 @@
+import errno
+import hashlib
+import json
+import os
+
+from utils import *
+from ioengine import each
+
+# Mounting rebuilds the tree from the roots: every root is listed, and
+# every directory's manifest shard read. A MetaCache keeps what a mount
+# ended up knowing in a local file, <dir>/<store id>.json, so that the
+# next mount of the same store (same mode, key and roots) can start from
+# it instead:
+#
+#   {'version': 1, 'generations': [3, 3, 3],
+#    'dirs': [...], 'files': {name: [size, mtime]},
+#    'manifest': {dirpath: records}, 'segments': {...},
+#    'merkle': {dirpath: node}}
+#
+# It is only good while the roots have not changed since. Every root
+# keeps a generation number in .ufs-meta/generation, and whoever is
+# about to change a root (a mount, ucs-fsck --repair) bumps it first;
+# a mount does so once after every save of its own cache. The cache
+# records the generations it was saved at, and a mount that reads the
+# same numbers back from every root knows nothing has changed since
+# and can skip the scan.
+VERSION = 1
+
+def read_generation(backend):
+    data = backend.read_meta('generation')
+    return int(data) if data else 0
+
+# Bump the generation of every root. Returns the new generations.
+def bump_generations(backends, generations, io=None):
+    generations = [generation + 1 for generation in generations]
+    numbers = dict(zip(backends, generations))
+    each(io, backends, lambda backend: backend.write_meta('generation', str(numbers[backend])))
+    return generations
+
+# json gives back unicode; the tree is made of utf-8 strs
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_encode(key), _encode(item)) for key, item in value.items())
+    return value
+
+class MetaCache(object):
+    # identity is anything that tells stores apart (a string)
+    def __init__(self, directory, identity):
+        self.directory = os.path.expanduser(directory)
+        self.path = os.path.join(self.directory, hashlib.sha1(identity).hexdigest() + '.json')
+
+    # What was saved, if it was saved at generations. None otherwise.
+    def load(self, generations):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                log('metadata cache %s is unreadable: %s' % (self.path, e))
+            return None
+        if state.get('version') != VERSION:
+            return None
+        if state.get('generations') != generations:
+            log('the roots changed since %s was saved (generations %s, now %s)'
+                % (self.path, state.get('generations'), generations))
+            return None
+        return _encode(state)
+
+    # Save state as of generations, replacing what was saved before
+    def save(self, generations, state):
+        state = dict(state, version=VERSION, generations=generations)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as e:
+            log('could not save the metadata cache to %s: %s' % (self.path, e))
@@ -0,0 +1,133 @@
+import collections
+import threading
+import time
+
+from utils import *
+
+# Picks which pieces to read when more are stored than needed (raid4/5
+# needs any N-1 of N, ec any k of k+m). Every read's latency is tracked
+# per backend; reads go to the fastest backends first, and a read that
+# runs past its backend's p95 gets a hedge: the same need is also sent to
+# a spare backend, and whichever data arrives first is used.
+#
+# With an IOEngine the reads go through it, and count against the
+# per-root limits like everything else.
+class ReadScheduler(object):
+    def __init__(self, alpha=0.2, window=100, io=None):
+        self.io = io
+        self.alpha = alpha
+        self.window = window
+        self.ewma = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, backend, seconds):
+        with self.lock:
+            if backend not in self.ewma:
+                self.ewma[backend] = seconds
+                self.samples[backend] = collections.deque(maxlen=self.window)
+            else:
+                self.ewma[backend] = (1 - self.alpha) * self.ewma[backend] + self.alpha * seconds
+            self.samples[backend].append(seconds)
+
+    # Expected latency of backend, 0 if it has not been seen yet (so that
+    # it gets tried and measured).
+    def expected(self, backend):
+        with self.lock:
+            return self.ewma.get(backend, 0.0)
+
+    # 95th percentile latency of backend, None until there are enough
+    # samples to say.
+    def p95(self, backend):
+        with self.lock:
+            samples = sorted(self.samples.get(backend, ()))
+        if len(samples) < 10:
+            return None
+        return samples[int(len(samples) * 0.95) - 1]
+
+    def _read(self, key, piece, results):
+        start = time.time()
+        try:
+            data = read_piece(piece)
+        except (IOError, OSError) as e:
+            log('reading %s from %s failed: %s' % (piece.path(), piece.backend, e))
+            data = None
+        self._finished(key, piece, data, time.time() - start, results)
+
+    # The same through the engine, once its task is done
+    def _submit(self, key, piece, results):
+        start = time.time()
+        def done(task):
+            try:
+                data = task.result()
+            except Exception as e:
+                log('reading %s from %s failed: %s' % (piece.path(), piece.backend, e))
+                data = None
+            self._finished(key, piece, data, time.time() - start, results)
+        location = getattr(piece, 'location', None)
+        # A failed read is replaced by a spare rather than retried
+        self.io.submit(piece.backend, read_piece, piece, size=location[2] if location else 0,
+                       retry=False, done=done)
+
+    def _finished(self, key, piece, data, seconds, results):
+        self.record(piece.backend, seconds)
+        with results.cond:
+            results.finished[key] = data
+            results.cond.notify_all()
+
+    # Read `needed` of the candidate pieces ({key: piece}), fastest
+    # backends first. Returns {key: data} with at least `needed` entries
+    # (more if several arrived at once), or fewer if not enough of the
+    # candidates could be read.
+    def fetch(self, candidates, needed):
+        spares = sorted(candidates, key=lambda key: self.expected(candidates[key].backend))
+        results = _Results()
+        inflight = {}
+
+        def launch():
+            key = spares.pop(0)
+            p95 = self.p95(candidates[key].backend)
+            inflight[key] = time.time() + p95 if p95 is not None else None
+            if self.io is not None:
+                self._submit(key, candidates[key], results)
+                return
+            worker = threading.Thread(target=self._read, args=(key, candidates[key], results))
+            worker.daemon = True
+            worker.start()
+
+        for i in range(min(needed, len(spares))):
+            launch()
+
+        got = {}
+        with results.cond:
+            while len(got) < needed:
+                for key, data in results.finished.items():
+                    inflight.pop(key, None)
+                    if data is not None:
+                        got[key] = data
+                    elif spares:
+                        # Failed: replace it right away
+                        launch()
+                results.finished.clear()
+                if len(got) >= needed:
+                    break
+                if not inflight:
+                    break
+
+                now = time.time()
+                for key, deadline in inflight.items():
+                    if deadline is not None and deadline <= now and spares:
+                        log('%s is slow, hedging' % candidates[key].backend)
+                        inflight[key] = None
+                        launch()
+
+                deadlines = [d for d in inflight.values() if d is not None]
+                timeout = max(min(deadlines) - now, 0.001) if deadlines and spares else None
+                results.cond.wait(timeout)
+
+        return got
+
+class _Results(object):
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.finished = {}
@@ -0,0 +1,172 @@
+import binascii
+import json
+import os
+import threading
+import time
+
+from utils import *
+from ioengine import each
+
+# Small files are not stored as pieces of their own. Each flush packs the
+# pieces of all the small files it uploads into one new segment file per
+# root (.ufs-meta/segments/<id>), so that flushing thousands of small
+# files costs one write per root instead of thousands. Where each piece
+# went is kept in the file's manifest record:
+#
+#   'packed': {'segment': id, 'pieces': [[name, offset, length], ...]}
+#
+# with one entry per root, in the order the roots were given.
+#
+# Segments are never changed once written. Overwriting or deleting a
+# packed file leaves garbage behind in its segment; segments that are
+# mostly garbage get compacted by copying what is still live into a new
+# segment.
+
+def segment_name(sid):
+    return 'segments/' + sid
+
+def new_segment_id():
+    return '%x-%s' % (int(time.time()), binascii.hexlify(os.urandom(4)))
+
+# The pieces of one new segment, collected in memory until it is written
+# (and counted in memory, if given, until then).
+class SegmentWriter(object):
+    def __init__(self, backends, io=None, memory=None):
+        self.backends = backends
+        self.io = io
+        self.memory = memory
+        self.held = 0
+        self.sid = new_segment_id()
+        self.chunks = [[] for backend in backends]
+        self.sizes = [0] * len(backends)
+        self.files = {}
+
+    def add(self, filename, backend, name, data):
+        i = self.backends.index(backend)
+        pieces = self.files.setdefault(filename, [None] * len(self.backends))
+        pieces[i] = [name, self.sizes[i], len(data)]
+        self.chunks[i].append(data)
+        if self.memory is not None:
+            self.memory.force(len(data))
+            self.held += len(data)
+        self.sizes[i] += len(data)
+
+    # Let go of the pieces, written or not
+    def drop(self):
+        self.chunks = [[] for backend in self.backends]
+        if self.memory is not None:
+            self.memory.release(self.held)
+        self.held = 0
+
+    # Bytes of filename's pieces, over all roots
+    def size_of(self, filename):
+        return sum(length for name, offset, length in self.files[filename])
+
+    # Write the segment to every root. Returns {filename: location} for
+    # the manifest records.
+    def write(self):
+        def write(backend):
+            i = self.backends.index(backend)
+            log('writing segment %s (%d bytes) to %s' % (self.sid, self.sizes[i], backend))
+            backend.write_meta(segment_name(self.sid), ''.join(self.chunks[i]))
+        try:
+            each(self.io, self.backends, write)
+        finally:
+            self.drop()
+        return dict((filename, {'segment': self.sid, 'pieces': pieces})
+                    for filename, pieces in self.files.items())
+
+# Which files are live in which segment, and how big everything is, so
+# that the segments worth compacting can be found without reading the
+# manifest. Replicated to every root as .ufs-meta/segments.json:
+#
+#   {id: {'size': bytes, 'files': {filename: bytes}}}
+class SegmentTable(object):
+    def __init__(self, backends, io=None):
+        self.backends = backends
+        self.io = io
+        self.segments = None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if self.segments is None:
+            self.segments = {}
+            for backend in self.backends:
+                try:
+                    data = backend.read_meta('segments.json')
+                except (IOError, OSError):
+                    continue
+                if data is not None:
+                    self.segments = json.loads(data)
+                    break
+        return self.segments
+
+    # The table if it was read, None if not, and a way to start from one
+    # saved before (see metacache.py)
+    def loaded(self):
+        with self.lock:
+            return self.segments
+
+    def preload(self, segments):
+        with self.lock:
+            self.segments = segments
+
+    def add(self, sid, size, files):
+        with self.lock:
+            self._load()[sid] = {'size': size, 'files': files}
+            self.dirty = True
+
+    def size(self, sid):
+        with self.lock:
+            return self._load()[sid]['size']
+
+    def files(self, sid):
+        with self.lock:
+            return dict(self._load()[sid]['files'])
+
+    # filename no longer lives in sid
+    def release(self, sid, filename):
+        with self.lock:
+            segment = self._load().get(sid)
+            if segment and segment['files'].pop(filename, None) is not None:
+                self.dirty = True
+
+    def rename(self, old, new):
+        with self.lock:
+            for segment in self._load().values():
+                files = segment['files']
+                for filename in list(files):
+                    if filename == old or filename.startswith(old + '/'):
+                        files[new + filename[len(old):]] = files.pop(filename)
+                        self.dirty = True
+
+    def drop(self, sid):
+        with self.lock:
+            self._load().pop(sid, None)
+            self.dirty = True
+
+    # Segments whose live bytes are below threshold of their size
+    def garbage(self, threshold):
+        with self.lock:
+            return [sid for sid, segment in self._load().items()
+                    if sum(segment['files'].values()) < threshold * segment['size']]
+
+    # The table if it changed, None if not, and a way to take it back as
+    # changed (see apply_journal)
+    def changes(self):
+        with self.lock:
+            return self._load() if self.dirty else None
+
+    def redo(self, segments):
+        with self.lock:
+            self.segments = segments
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self._load())
+            each(self.io, self.backends, lambda backend: backend.write_meta('segments.json', data))
+            self.dirty = False
@@ -5,8 +5,12 @@ import subprocess
 import os
 import subprocess
 import sys
+import threading
+import time
 from subprocess import Popen
 
+# Starts the CloudFusion mount for one account. Returns when it was
+# started, or None if the account is not configured.
 def checkService(service):
     provider = (ConfigSectionMap(service)['provider'])
     user = (ConfigSectionMap(service)['user'])
@@ -14,7 +18,7 @@ def checkService(service):
     print user
     print password
     if not user and not password: 
-       return 
+       return None
     DBConfig = ConfigParser.ConfigParser()
     if provider == "Box":
         DBConfig.read("/usr/lib/python2.7/site-packages/CloudFusion-5.10.16-py2.7.egg/cloudfusion/config/Webdav.ini")
@@ -31,15 +35,101 @@ def checkService(service):
         DBConfig.write(configfile)
     if not os.path.exists(service):
         os.makedirs(service)
+    started = time.time()
     Popen(["cloudfusion","--config",service+'.ini',service])
+    return started
+
+# Where the files of a mounted account are: CloudFusion shows them under
+# data/ in its mountpoint.
+def backendRoot(service):
+    data = os.path.join(service, 'data')
+    if os.path.isdir(data):
+        return data
+    return service
+
+# The root to give UnifiedCloudStorage for an account: where its files
+# are, with the rate limits set for the account (ops = requests per
+# second, rate = bytes per second, e.g. 2M) as backend options.
+def backendSpec(service):
+    options = []
+    for key in ('weight', 'ops', 'rate'):
+        if Config.has_option(service, key) and Config.get(service, key):
+            options.append('%s=%s' % (key, Config.get(service, key)))
+    root = backendRoot(service)
+    if options:
+        root += '?' + '&'.join(options)
+    return root
+
+# Waits for one account's mount to come up: it has to be mounted, list
+# its root, and take a small write that reads back the same. Stores the
+# seconds it took since started in results, or None if it never did.
+def probeBackend(service, started, timeout, results):
+    deadline = started + timeout
+    while time.time() < deadline:
+        try:
+            if os.path.ismount(service):
+                root = backendRoot(service)
+                os.listdir(root)
+                probe = os.path.join(root, '.ucs-probe-%d' % os.getpid())
+                with open(probe, 'w') as f:
+                    f.write('ucs')
+                with open(probe) as f:
+                    ok = f.read() == 'ucs'
+                os.remove(probe)
+                if ok:
+                    results[service] = time.time() - started
+                    return
+        except (IOError, OSError):
+            pass
+        time.sleep(0.5)
+    results[service] = None
+
+# Probes every started account at once, so that waiting takes as long as
+# the slowest one. Returns {service: seconds to ready or None}.
+def waitForBackends(started, timeout):
+    results = {}
+    threads = []
+    for service in sorted(started):
+        thread = threading.Thread(target=probeBackend, args=(service, started[service], timeout, results))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # A probe can hang on a half-mounted root; don't wait past its deadline
+        thread.join(max(0, max(started.values()) + timeout - time.time()))
+    for service in started:
+        results.setdefault(service, None)
+    return results
+
+def startUCS(roots):
+    if not Config.has_section('Mounts'):
+        print "No [Mounts] section in ucs.conf, not starting UnifiedCloudStorage"
+        return 1
+    mounts = ConfigSectionMap('Mounts')
+    mountpoint = mounts.get('mountpoint')
+    if not mountpoint:
+        print "No mountpoint in [Mounts], not starting UnifiedCloudStorage"
+        return 1
+    mode = mounts.get('mode') or 'raid5'
+    # Every mode but raid0 encrypts with a key made from the keyphrase
+    keyphrase = mounts.get('keyphrase')
+    if mode != 'raid0' and not keyphrase:
+        print "No keyphrase in [Mounts], not starting UnifiedCloudStorage"
+        return 1
+    args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unified.py'),
+            '--' + mode, mountpoint]
+    if mode != 'raid0':
+        args.append(keyphrase)
+    args.extend(roots)
+    print "Starting UnifiedCloudStorage on " + mountpoint
+    return subprocess.call(args)
 
 def checkSudo():
     user = os.getuid()
     if user != 0:
         print "This program requires root privileges.  Run as root using 'sudo'."
-        return 
+        sys.exit(1)
     checkCloudFusion()
-    sys.exit()
 
 def checkCloudFusion():
     try:
@@ -72,14 +162,38 @@ def ConfigSectionMap(section):
 Config = ConfigParser.ConfigParser()
 Config.read("ucs.conf")
 checkSudo()
+
+# Start every account's mount first, then wait for all of them at once
+started = {}
+services = []
 x = 1
-while True:
-    try:
-        print (ConfigSectionMap('Account'+str(x))['provider'])
-        checkService('Account'+str(x))
-        x += 1
-    except:
-        break
+while Config.has_section('Account'+str(x)):
+    service = 'Account'+str(x)
+    print (ConfigSectionMap(service)['provider'])
+    when = checkService(service)
+    if when is not None:
+        started[service] = when
+        services.append(service)
+    x += 1
+
+timeout = 120
+if Config.has_option('Mounts', 'timeout'):
+    timeout = Config.getfloat('Mounts', 'timeout')
+results = waitForBackends(started, timeout)
+for service in services:
+    if results[service] is None:
+        print "%s: not ready after %ds" % (service, timeout)
+    else:
+        print "%s: ready in %.1fs" % (service, results[service])
+
+if not started:
+    print "No accounts configured"
+    sys.exit(1)
+if None in results.values():
+    print "Not starting UnifiedCloudStorage until every account is mounted"
+    sys.exit(1)
+# In account order: the roots' order decides where parity goes
+sys.exit(startUCS([backendSpec(service) for service in services]))
 
 #checkService("Dropbox")
 #checkService("Google")
@@ -0,0 +1,139 @@
+import hashlib
+import struct
+
+from utils import *
+from backend import backend_from_spec
+from erasure import ReedSolomon
+from ioengine import IOEngine
+from journal import Journal
+from manifest import Manifest
+from memory import MemoryBudget
+from segments import segment_name
+
+# A store as it is on its roots, without the mount around it: its mode
+# and key, the roots, the engine backend calls run on, the journal and
+# manifest the roots replicate, and where a file's pieces go. The mount
+# (unified.py) is one; ucs-fsck works on one of its own, and so does not
+# need libfuse.
+
+# Requests in flight to one root at a time, see ioengine.py
+IO_PER_ROOT = 32
+
+# Memory the mount may hold in buffers, see memory.py
+MEMORY_LIMIT = 256 << 20
+
+# Length of the file encrypt_file writes, read from the size header at
+# the start of it.
+def encrypted_size(header):
+    origsize = struct.unpack('<Q', header[:struct.calcsize('Q')])[0]
+    return struct.calcsize('Q') + 16 + (origsize + 15) / 16 * 16
+
+# The rotation the most of a file's pieces were placed with, from
+# (root index, piece) pairs, or None if there are none: piece i of block
+# (or row) u on root j was placed with rotation j - i - u. record is the
+# file's manifest record.
+def located_rotation(located, record, n):
+    votes = {}
+    for index, piece in located:
+        unit = piece.block or 0
+        if 'row' in record and piece.typ == 'raw':
+            unit = piece.block / record['row']
+        start = (index - piece.numer - unit) % n
+        votes[start] = votes.get(start, 0) + 1
+    if not votes:
+        return None
+    return max(votes, key=votes.get)
+
+class Store(object):
+    def __init__(self, raidver, roots, io_per_root=IO_PER_ROOT, memory_limit=MEMORY_LIMIT):
+        if raidver == '--raid0':
+            self.raid = 0
+        elif raidver in ('--raid4', '--raid5'):
+            self.raid = int(raidver[-1])
+            self.key = hashlib.sha256(roots[0]).digest()
+            roots = roots[1:]
+        elif raidver.startswith('--ec='):
+            self.raid = 'ec'
+            k, _, m = raidver[len('--ec='):].partition('+')
+            self.rs = ReedSolomon(int(k), int(m or 0))
+            self.key = hashlib.sha256(roots[0]).digest()
+            roots = roots[1:]
+            if len(roots) != self.rs.k + self.rs.m:
+                error('--ec=%d+%d needs %d sub-filesystems' % (self.rs.k, self.rs.m, self.rs.k + self.rs.m))
+        else:
+            error('Unrecognized RAID flag: ' + raidver)
+        self.backends = [backend_from_spec(root) for root in roots]
+
+        # Everything buffered in memory is counted against one budget
+        # (None for no limit)
+        self.memory = MemoryBudget(memory_limit)
+
+        # Backend calls are run by the engine, many at once
+        self.io = IOEngine(io_per_root, self.memory)
+
+        # Metadata operations are journaled to the roots and applied to
+        # them incrementally
+        self.journal = Journal(self.backends, self.io)
+
+        # Per-file layout records, mirrored to every root
+        self.manifest = Manifest(self.backends, self.io)
+
+    # The backends in the order filename's pieces go to them: parity
+    # first, then the data pieces. raid4 always puts parity on the first
+    # root; raid5 (and ec) rotate the order per file, and per block (or
+    # row) within a file, so parity writes and reconstruction reads
+    # spread over all roots. The rotation is picked when the file is
+    # first stored and kept in its record, so that a renamed file's
+    # pieces are still found where they are (see file_rotation).
+    def placement(self, filename, block=None):
+        record = self.manifest.get(filename) or {}
+        return self.rotated(record.get('rotation', rotation(filename, len(self.backends))), block)
+
+    # The backends in piece order for a file placed with rotation start
+    def rotated(self, start, block=None):
+        if self.raid == 4:
+            return self.backends
+        start = (start + (block or 0)) % len(self.backends)
+        return self.backends[start:] + self.backends[:start]
+
+    # The rotation filename is placed with. Records from before it was
+    # recorded get the one its pieces agree on (see located_rotation).
+    def file_rotation(self, filename):
+        record = self.manifest.get(filename) or {}
+        if 'rotation' in record:
+            return record['rotation']
+        if self.raid in (5, 'ec') and record and 'packed' not in record:
+            located = []
+            for block, pieces in self.file_pieces(filename).items():
+                for piece in pieces.values():
+                    located.append((self.backends.index(piece.backend), piece))
+            start = located_rotation(located, record, len(self.backends))
+            if start is not None:
+                return start
+        return rotation(filename, len(self.backends))
+
+    # The pieces of a packed file, from its manifest record, one per
+    # backend. Each reads from its range of the backend's segment.
+    def packed_pieces(self, record):
+        pieces = []
+        name = segment_name(record['packed']['segment'])
+        for backend, (piece_name, offset, length) in zip(self.backends, record['packed']['pieces']):
+            if self.raid == 0:
+                piece = RawFilePiece(piece_name, 0, 0)
+            else:
+                piece = fileToFilePiece(piece_name)
+            piece.backend = backend
+            piece.location = (name, offset, length)
+            pieces.append(piece)
+        return pieces
+
+    # The stored pieces of one file, grouped like find_pieces does
+    def file_pieces(self, filename):
+        found = {}
+        listings = self.io.each(self.backends, lambda backend: backend.pieces(filename))
+        for backend, listing in zip(self.backends, listings):
+            for relpath in listing:
+                piece = fileToFilePiece(relpath)
+                piece.backend = backend
+                found.setdefault(piece.block, {})[piece.numer] = piece
+        return found
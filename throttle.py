@@ -0,0 +1,126 @@
+import errno
+import random
+import threading
+import time
+
+from utils import *
+
+# Cloud providers throttle: past some rate they start failing requests
+# (429s, which CloudFusion turns into EIO) or slowing them down, and
+# retrying right away only makes it worse. Each root gets a Throttle that
+# keeps it under its configured ops/sec and bytes/sec, and that backs off
+# when the root shows it is overloaded:
+#
+# - a transient error pauses the root for a while (doubling with every
+#   error in a row, with jitter) and the request is retried;
+# - errors and latency spikes halve the share of the configured rates
+#   used, which then grows back a little with every request that goes
+#   well (AIMD, as TCP does).
+
+# Errors that mean try again later
+TRANSIENT = (errno.EIO, errno.EAGAIN, errno.EBUSY, errno.ETIMEDOUT, errno.ECONNRESET)
+
+RETRIES = 6
+BACKOFF = 0.1
+MAX_BACKOFF = 30.0
+
+# Least share of the configured rates ever used
+MIN_FACTOR = 1 / 16.0
+
+# A request this many times slower than usual is a spike
+SPIKE = 4.0
+
+# Only requests moving less than this say anything about latency
+SMALL = 64 * 1024
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else self.rate
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    # Take n tokens, refilled at factor times the rate, and sleep until
+    # they have been earned. The bucket may go into debt, so requests
+    # bigger than the burst still get through, and callers queue up
+    # behind each other's debt.
+    def take(self, n, factor=1.0):
+        rate = self.rate * factor
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * rate)
+            self.stamp = now
+            self.tokens -= n
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+class Throttle(object):
+    # ops and rate (bytes) per second, None for no limit
+    def __init__(self, name, ops=None, rate=None):
+        self.name = name
+        self.ops = TokenBucket(ops) if ops else None
+        self.bytes = TokenBucket(rate) if rate else None
+        self.factor = 1.0
+        self.latency = None
+        self.failures = 0
+        self.resume = 0.0
+        self.lock = threading.Lock()
+
+    # Call fn(*args), which moves size bytes (0 if not known beforehand),
+    # within the limits, retrying transient errors if retry is set.
+    def call(self, fn, args, size=0, retry=True):
+        attempt = 0
+        while True:
+            self._wait(size)
+            start = time.time()
+            try:
+                result = fn(*args)
+            except (IOError, OSError) as e:
+                if not self._failed(e) or not retry or attempt >= RETRIES:
+                    raise
+                attempt += 1
+                continue
+            moved = size or (len(result) if isinstance(result, str) else 0)
+            self._succeeded(time.time() - start, moved)
+            if not size and moved and self.bytes is not None:
+                # Reads only know their size once done: pay afterwards
+                self.bytes.take(moved, self.factor)
+            return result
+
+    def _wait(self, size):
+        with self.lock:
+            delay = self.resume - time.time()
+            factor = self.factor
+        if delay > 0:
+            time.sleep(delay)
+        if self.ops is not None:
+            self.ops.take(1, factor)
+        if self.bytes is not None and size:
+            self.bytes.take(size, factor)
+
+    # Returns whether the error is worth retrying
+    def _failed(self, e):
+        if getattr(e, 'errno', None) not in TRANSIENT:
+            return False
+        with self.lock:
+            self.failures += 1
+            delay = min(MAX_BACKOFF, BACKOFF * 2 ** (self.failures - 1)) * random.uniform(0.5, 1.0)
+            self.resume = max(self.resume, time.time() + delay)
+            self.factor = max(MIN_FACTOR, self.factor / 2)
+        log('%s: %s, backing off for %.1fs' % (self.name, e, delay))
+        return True
+
+    def _succeeded(self, seconds, moved):
+        with self.lock:
+            self.failures = 0
+            if moved >= SMALL:
+                spike = False
+            else:
+                spike = self.latency is not None and seconds > SPIKE * self.latency and seconds > 0.01
+                self.latency = seconds if self.latency is None else 0.9 * self.latency + 0.1 * seconds
+            if spike:
+                self.factor = max(MIN_FACTOR, self.factor / 2)
+            else:
+                self.factor = min(1.0, self.factor + 0.01)
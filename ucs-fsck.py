@@ -0,0 +1,612 @@
+#!/usr/bin/python2
+
+from __future__ import with_statement, print_function
+
+import Queue
+import collections
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+from utils import *
+from backend import parse_size
+from manifest import shard_name
+from merkle import node_name
+from metacache import bump_generations, read_generation
+from segments import segment_name
+from store import MEMORY_LIMIT, Store, encrypted_size, located_rotation
+
+# Checks a store on its roots without mounting it, and repairs what the
+# redundancy allows. Every logical file is laid out the way the mount
+# would lay it out (from its manifest record: size, stripe sizes, block
+# map), and every piece is checked for being there, on the root it
+# belongs on, at the length it should have and with the md5 it was
+# stored with. Files packed into segments are checked a segment at a
+# time, and the metadata the roots replicate (manifest shards, tree
+# hashes, segment table) for being on every root.
+#
+# With --repair, missing and damaged pieces are rebuilt from the rest of
+# their stripe, block or row and written back, segments are patched in
+# place, missing directories are made and missing metadata is copied
+# over from another root; an empty root put in place of a lost one is
+# rebuilt this way. A store whose journal still has records to replay is
+# only verified: mount it once first.
+#
+# Pieces are streamed a chunk at a time, on a few threads working on
+# different files, within the mount's memory budget. Every file checked
+# is appended to the --state file, so that a run that was stopped picks
+# up where it left off when started again with the same file.
+
+CHUNK = 1 << 20
+THREADS = 4
+
+# A raid0 share: the file itself, under its own name on every root
+class Share(object):
+    def __init__(self, basename, numer):
+        self.basename = basename
+        self.numer = numer
+        self.block = None
+
+    def path(self):
+        return self.basename
+
+# Pieces that protect each other, {numer: piece}: the pieces of a file
+# stored whole, of one block or of one row. kind is 'xor' (one parity
+# piece), 'rs' or 'share' (raid0, no redundancy). Each piece knows the
+# backend it belongs on, its length and md5 (None where not known).
+class Group(object):
+    def __init__(self, name, kind, pieces):
+        self.name = name
+        self.kind = kind
+        self.pieces = pieces
+
+# Length of the encrypted copy of size bytes
+def encrypted_length(size):
+    return encrypted_size(struct.pack('<Q', size))
+
+class Fsck(object):
+    def __init__(self, fs, repair=False, threads=THREADS, state=None):
+        self.fs = fs
+        self.backends = fs.backends
+        self.repair = repair
+        self.threads = threads
+        self.state = state
+        self.lock = threading.Lock()
+        self.health = [collections.Counter() for backend in self.backends]
+        self.results = collections.Counter()
+        # (item, status, what was wrong) of every item that was not ok
+        self.problems = []
+        self.done = set()
+
+    def run(self):
+        for backend in self.backends:
+            backend.ensure()
+        pending = self.fs.journal.load()
+        if pending:
+            log('the journal has %d records to replay: mount the store once to apply them' % len(pending))
+            if self.repair:
+                error('not repairing a store with an unapplied journal')
+        if self.repair:
+            # Mounts must not trust what they cached about these roots
+            generations = self.fs.io.each(self.backends, read_generation)
+            bump_generations(self.backends, generations, self.fs.io)
+        self._resume()
+
+        log('listing the roots...')
+        self._list()
+        items = self._items()
+        self._check_dirs()
+
+        todo = Queue.Queue()
+        for item in items:
+            if '%s:%s' % item not in self.done:
+                todo.put(item)
+        log('%d items to check, %d done before' % (todo.qsize(), len(items) - todo.qsize()))
+        self.started = time.time()
+        self.count = 0
+        workers = []
+        for i in range(self.threads):
+            todo.put(None)
+            worker = threading.Thread(target=self._work, args=(todo,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return self.report()
+
+    ############################################################################
+    # What there is to check
+
+    # Everything stored on every root, and the directories of each
+    def _list(self):
+        listings = self.fs.io.each(self.backends, lambda backend: list(backend.walk(prefetch=4)))
+        self.listed = set()
+        self.dirs = [set(['']) for backend in self.backends]
+        self.found = {}
+        # basename -> [(root index, piece)] of every piece listed
+        self.located = collections.defaultdict(list)
+        for i, listing in enumerate(listings):
+            for relpath, entry, st in listing:
+                if entry.is_dir():
+                    self.dirs[i].add(relpath)
+                    continue
+                self.listed.add((i, relpath))
+                if self.fs.raid == 0:
+                    self.found[relpath] = True
+                    continue
+                try:
+                    piece = fileToFilePiece(relpath)
+                    self.found[piece.basename] = True
+                    self.located[piece.basename].append((i, piece))
+                except Exception:
+                    log('%s: %s is not a piece, skipping it' % (self.backends[i], relpath))
+        self.all_dirs = set.union(*self.dirs)
+
+    # ('meta', name), ('file', filename) and ('segment', sid) items. Files
+    # are whatever has pieces or a manifest record; packed files are
+    # checked with their segment.
+    def _items(self):
+        manifest = self.fs.manifest
+        self.packed = collections.defaultdict(list)
+        files = set(self.found)
+        meta = set(['segments.json', 'checkpoint'])
+        for dirpath in self.all_dirs:
+            meta.add(node_name(dirpath))
+            records = manifest.records(dirpath)
+            if records:
+                meta.add(shard_name(dirpath))
+            for name, record in records.items():
+                filename = dirpath + '/' + name if dirpath else name
+                if 'packed' in record:
+                    self.packed[record['packed']['segment']].append(filename)
+                    files.discard(filename)
+                else:
+                    files.add(filename)
+        return ([('meta', name) for name in sorted(meta)] + [('file', name) for name in sorted(files)] +
+                [('segment', sid) for sid in sorted(self.packed)])
+
+    # Directories some root lacks
+    def _check_dirs(self):
+        for i, backend in enumerate(self.backends):
+            missing = sorted(self.all_dirs - self.dirs[i])
+            if not missing:
+                continue
+            log('%s lacks %d directories' % (backend, len(missing)))
+            self.health[i]['missing_dirs'] += len(missing)
+            if self.repair:
+                # Parents sort before their children
+                for dirpath in missing:
+                    backend.mkdir(dirpath)
+
+    ############################################################################
+    # Resuming
+
+    def _resume(self):
+        header = {'roots': [repr(backend) for backend in self.backends], 'repair': self.repair}
+        if self.state is None:
+            self.log = None
+            return
+        if os.path.exists(self.state):
+            with open(self.state) as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if lines and lines[0] != header:
+                error('%s is from another run (other roots, or with%s --repair)'
+                      % (self.state, 'out' if self.repair else ''))
+            for line in lines[1:]:
+                self._record(line)
+            log('resuming: %d items were checked before' % len(self.done))
+        else:
+            with open(self.state, 'w') as f:
+                f.write(json.dumps(header) + '\n')
+        self.log = open(self.state, 'a')
+
+    # Fold the result of one item into the totals
+    def _record(self, line):
+        self.done.add(line['item'])
+        kind = line['item'].partition(':')[0]
+        self.results[kind, line['status']] += 1
+        for i, counts in line['health'].items():
+            self.health[int(i)].update(counts)
+        if line['status'] != 'ok':
+            self.problems.append((line['item'], line['status'], line['detail']))
+
+    ############################################################################
+    # Checking
+
+    def _work(self, todo):
+        while True:
+            item = todo.get()
+            if item is None:
+                return
+            kind, name = item
+            health = collections.defaultdict(collections.Counter)
+            detail = []
+            try:
+                status = getattr(self, 'check_' + kind)(name, health, detail)
+            except (IOError, OSError) as e:
+                status = 'failed'
+                detail.append(str(e))
+            line = {'item': '%s:%s' % item, 'status': status, 'detail': detail,
+                    'health': dict((i, dict(counts)) for i, counts in health.items())}
+            with self.lock:
+                self._record(line)
+                if self.log is not None:
+                    self.log.write(json.dumps(line) + '\n')
+                    self.log.flush()
+                self.count += 1
+                if self.count % 1000 == 0:
+                    log('%d items checked in %ds' % (self.count, time.time() - self.started))
+            if status != 'ok':
+                log('%s %s: %s (%s)' % (kind, name, status, '; '.join(detail)))
+
+    # Metadata every root has a copy of
+    def check_meta(self, name, health, detail):
+        copies = [backend.throttle.call(backend.read_meta, (name,)) for backend in self.backends]
+        if all(copy is None for copy in copies):
+            # Nothing written there yet (an empty tree, say)
+            return 'ok'
+        good = None
+        bad = []
+        for i, copy in enumerate(copies):
+            health[i]['pieces'] += 1
+            if copy is None:
+                health[i]['missing'] += 1
+                bad.append(i)
+                continue
+            health[i]['bytes'] += len(copy)
+            if name != 'checkpoint':
+                try:
+                    json.loads(copy)
+                except ValueError:
+                    health[i]['corrupt'] += 1
+                    bad.append(i)
+                    continue
+            if good is None:
+                good = copy
+        if not bad:
+            return 'ok'
+        detail.append('bad on %s' % ', '.join(repr(self.backends[i]) for i in bad))
+        if good is None:
+            return 'lost'
+        if not self.repair:
+            return 'damaged'
+        for i in bad:
+            self.backends[i].throttle.call(self.backends[i].write_meta, (name, good))
+            health[i]['repaired'] += 1
+        return 'repaired'
+
+    def check_file(self, filename, health, detail):
+        groups = self.layout(filename, self.fs.manifest.get(filename))
+        if groups is None:
+            detail.append('no size in the manifest to check it against')
+            return 'unchecked'
+        statuses = [self._check_group(group, health, detail) for group in groups]
+        for status in ('lost', 'damaged', 'repaired'):
+            if status in statuses:
+                return status
+        return 'ok'
+
+    # Check (and repair) one group; returns its status
+    def _check_group(self, group, health, detail, segments=None, patches=None):
+        bad = []
+        for n, piece in sorted(group.pieces.items()):
+            i = self.backends.index(piece.backend)
+            problem = self._check_piece(piece, health[i], segments[i] if segments is not None else None)
+            if problem is not None:
+                bad.append(n)
+                health[i][problem] += 1
+                detail.append('%s piece %s on %s: %s' % (group.name, n, piece.backend, problem))
+        if not bad:
+            return 'ok'
+
+        spare = {'xor': 1, 'rs': self.fs.rs.m if self.fs.raid == 'ec' else 0, 'share': 0}[group.kind]
+        if len(bad) > spare:
+            return 'lost'
+        if not self.repair:
+            return 'damaged'
+        if segments is not None:
+            rebuilt = self._rebuild_packed(group, bad, segments)
+            for n in bad:
+                piece = group.pieces[n]
+                patches[self.backends.index(piece.backend)].append((piece.location[1], rebuilt[n]))
+        else:
+            self._rebuild(group, bad)
+        for n in bad:
+            health[self.backends.index(group.pieces[n].backend)]['repaired'] += 1
+        return 'repaired'
+
+    # Read one piece through (or slice it out of its root's copy of the
+    # segment it is packed into). Returns what is wrong with it, or None.
+    def _check_piece(self, piece, counts, segment=None):
+        counts['pieces'] += 1
+        location = getattr(piece, 'location', None)
+        digest = hashlib.md5()
+        if location is not None:
+            if segment is None:
+                return 'missing'
+            data = segment[location[1]:location[1] + location[2]]
+            digest.update(data)
+            length = len(data)
+        else:
+            if (self.backends.index(piece.backend), piece.path()) not in self.listed:
+                return 'missing'
+            start = time.time()
+            length = 0
+            try:
+                with piece.backend.throttle.call(open_piece, (piece,)) as source:
+                    while True:
+                        chunk = piece.backend.throttle.call(source.read, (CHUNK,))
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        length += len(chunk)
+            except (IOError, OSError) as e:
+                log('reading %s from %s failed: %s' % (piece.path(), piece.backend, e))
+                return 'unreadable'
+            finally:
+                counts['seconds'] += time.time() - start
+        counts['bytes'] += length
+        if piece.length is not None and length != piece.length:
+            return 'length'
+        if piece.sum is not None and digest.hexdigest() != piece.sum:
+            return 'corrupt'
+        return None
+
+    # Chunks of the pieces in bad, from chunks ({numer: data}) of the
+    # others at the same offset
+    def _recover(self, group, chunks, bad):
+        if group.kind == 'xor':
+            longest = max(len(data) for data in chunks.values())
+            return {bad[0]: xor_bytes(*[data + '\0' * (longest - len(data)) for data in chunks.values()])}
+        rs = self.fs.rs
+        data = rs.decode(chunks)
+        parity = rs.encode(data) if any(n >= rs.k for n in bad) else []
+        return dict((n, data[n] if n < rs.k else parity[n - rs.k]) for n in bad)
+
+    # The pieces a group's bad pieces are rebuilt from
+    def _sources(self, group, bad):
+        good = [n for n in sorted(group.pieces) if n not in bad]
+        return good[:self.fs.rs.k] if group.kind == 'rs' else good
+
+    # Stream the bad pieces of group back from the others, straight to
+    # the roots they belong on
+    def _rebuild(self, group, bad):
+        good = self._sources(group, bad)
+        sources = {}
+        outputs = {}
+        with self.fs.memory.hold((len(group.pieces) + 2) * CHUNK):
+            try:
+                for n in good:
+                    piece = group.pieces[n]
+                    sources[n] = piece.backend.throttle.call(open_piece, (piece,))
+                for n in bad:
+                    piece = group.pieces[n]
+                    log('rebuilding %s on %s' % (piece.path(), piece.backend))
+                    outputs[n] = piece.backend.open(piece.path(), 'wb')
+                for at in range(0, max(group.pieces[n].length for n in bad), CHUNK):
+                    chunks = dict((n, group.pieces[n].backend.throttle.call(sources[n].read, (CHUNK,)))
+                                  for n in good)
+                    rebuilt = self._recover(group, chunks, bad)
+                    for n in bad:
+                        outputs[n].write(rebuilt[n][:max(0, min(CHUNK, group.pieces[n].length - at))])
+            finally:
+                for handle in sources.values() + outputs.values():
+                    handle.close()
+
+    # The bad pieces of a packed group, from the segments ({root index:
+    # data}) the others are packed into
+    def _rebuild_packed(self, group, bad, segments):
+        chunks = {}
+        for n in self._sources(group, bad):
+            piece = group.pieces[n]
+            name, offset, length = piece.location
+            chunks[n] = segments[self.backends.index(piece.backend)][offset:offset + length]
+        rebuilt = self._recover(group, chunks, bad)
+        return dict((n, rebuilt[n][:group.pieces[n].location[2]]) for n in bad)
+
+    # All the files packed into one segment. Every root's copy of it is
+    # read whole, and patched in place where pieces were rebuilt.
+    def check_segment(self, sid, health, detail):
+        name = segment_name(sid)
+        files = self.packed[sid]
+        records = [(filename, self.fs.manifest.get(filename)) for filename in files]
+        size = sum(location[2] for filename, record in records
+                   for location in record['packed']['pieces'])
+        with self.fs.memory.hold(2 * size):
+            segments = {}
+            for i, backend in enumerate(self.backends):
+                start = time.time()
+                try:
+                    segments[i] = backend.throttle.call(backend.read_meta, (name,))
+                except (IOError, OSError) as e:
+                    log('reading %s from %s failed: %s' % (name, backend, e))
+                    segments[i] = None
+                health[i]['seconds'] += time.time() - start
+            patches = collections.defaultdict(list)
+            statuses = []
+            for filename, record in records:
+                for group in self.layout(filename, record):
+                    statuses.append(self._check_group(group, health, detail, segments, patches))
+
+            for i, found in patches.items():
+                data = bytearray(segments[i] or '')
+                end = max(offset + len(piece) for offset, piece in found)
+                data.extend('\0' * (end - len(data)))
+                for offset, piece in found:
+                    data[offset:offset + len(piece)] = piece
+                log('patching %d pieces into %s on %s' % (len(found), name, self.backends[i]))
+                self.backends[i].throttle.call(self.backends[i].write_meta, (name, bytes(data)))
+
+        for status in ('lost', 'damaged', 'repaired'):
+            if status in statuses:
+                return status
+        return 'ok'
+
+    ############################################################################
+    # Where the pieces of a file should be
+
+    # The rotation filename was placed with: the one in its record, or
+    # for records from before it was kept there, the one most of the
+    # pieces listed agree on
+    def _rotation(self, filename, record):
+        if 'rotation' in record:
+            return record['rotation']
+        start = located_rotation(self.located.get(filename, ()), record, len(self.backends))
+        return rotation(filename, len(self.backends)) if start is None else start
+
+    # The groups of filename's pieces, from its manifest record. Returns
+    # None if the record does not say enough.
+    def layout(self, filename, record):
+        fs = self.fs
+        if not record or ('size' not in record and 'packed' not in record):
+            return None
+        sums = record.get('sums') or {}
+        kind = {0: 'share', 4: 'xor', 5: 'xor', 'ec': 'rs'}[fs.raid]
+
+        if 'packed' in record:
+            pieces = {}
+            for i, piece in enumerate(fs.packed_pieces(record)):
+                if fs.raid == 0:
+                    piece.numer = i
+                    piece.sum = sums[i] if isinstance(sums, list) else None
+                else:
+                    piece.sum = sums.get(piece.path()[len(fileToFilePiece(piece.path()).basename):])
+                piece.length = piece.location[2]
+                pieces[piece.numer] = piece
+            return [Group(filename, kind, pieces)]
+
+        if fs.raid == 0:
+            pieces = {}
+            for i, backend in enumerate(self.backends):
+                pieces[i] = self._place(Share(filename, i), backend, record['size'],
+                                        sums[i] if isinstance(sums, list) else None)
+            return [Group(filename, kind, pieces)]
+
+        def place(piece, backend, length):
+            return self._place(piece, backend, length, sums.get(piece.path()[len(filename):]))
+
+        start = self._rotation(filename, record)
+        size = record['size']
+        if 'blocks' not in record:
+            total = encrypted_length(size)
+            backends = fs.rotated(start)
+            if fs.raid == 'ec':
+                return [self._shards(filename, None, total, backends, place)]
+            lengths = self._stripes(total, record.get('chunks'))
+            denom = len(lengths)
+            pieces = dict((i, place(RawFilePiece(filename, i, denom), backends[i], lengths[i - 1]))
+                          for i in range(1, denom + 1))
+            parity = max(lengths)
+            pieces[0] = place(XorFilePiece(filename, parity - lengths[-1], denom), backends[0], parity)
+            return [Group(filename, kind, pieces)]
+
+        block_size = record['block_size']
+        count = len(record['blocks'])
+        lengths = [encrypted_length(min(block_size, size - block * block_size)) for block in range(count)]
+        if 'row' not in record:
+            return [self._shards(filename, block, lengths[block], fs.rotated(start, block), place)
+                    for block in range(count)]
+
+        groups = []
+        per_row = record['row']
+        for row in range((count + per_row - 1) / per_row):
+            first = row * per_row
+            members = range(first, min(first + per_row, count))
+            backends = fs.rotated(start, row)
+            pieces = dict((block - first + 1, place(RawFilePiece(filename, block - first + 1, per_row, block),
+                                                    backends[block - first + 1], lengths[block]))
+                          for block in members)
+            pieces[0] = place(XorFilePiece(filename, 0, per_row, row), backends[0],
+                              max(lengths[block] for block in members))
+            groups.append(Group('%s row %d' % (filename, row), kind, pieces))
+        return groups
+
+    def _place(self, piece, backend, length, digest):
+        piece.backend = backend
+        piece.length = length
+        piece.sum = digest
+        return piece
+
+    # The k+m shards of total bytes (a whole file or one block)
+    def _shards(self, filename, block, total, backends, place):
+        rs = self.fs.rs
+        shard = (total + rs.k - 1) / rs.k
+        name = filename if block is None else '%s block %d' % (filename, block)
+        return Group(name, 'rs', dict((i, place(RsFilePiece(filename, i, rs.k, rs.m, block), backends[i], shard))
+                                      for i in range(rs.k + rs.m)))
+
+    # Lengths of the data pieces write_stripes cut total bytes into
+    def _stripes(self, total, chunks):
+        if not chunks:
+            denom = len(self.backends) - 1
+            chunk = (total + denom - 1) / denom
+            chunks = [chunk] * denom
+        lengths = []
+        start = 0
+        for chunk in chunks:
+            lengths.append(max(0, min(chunk, total - start)))
+            start += chunk
+        return lengths
+
+    ############################################################################
+
+    # Print what was found; returns the exit status: 0 if all was well,
+    # 1 if everything wrong was repaired, 4 if damage is left
+    def report(self):
+        print('%-40s %8s %10s %8s %8s %8s %10s %8s %8s %8s' % ('root', 'pieces', 'MB', 'missing', 'length',
+              'corrupt', 'unreadable', 'repaired', 'MB/s', 'health'))
+        for backend, counts in zip(self.backends, self.health):
+            bad = counts['missing'] + counts['length'] + counts['corrupt'] + counts['unreadable']
+            rate = counts['bytes'] / counts['seconds'] / (1 << 20) if counts['seconds'] else 0
+            health = 100.0 * (counts['pieces'] - bad) / counts['pieces'] if counts['pieces'] else 100.0
+            print('%-40s %8d %10.1f %8d %8d %8d %10d %8d %8.1f %7.2f%%' % (repr(backend)[-40:], counts['pieces'],
+                  counts['bytes'] / float(1 << 20), counts['missing'], counts['length'], counts['corrupt'],
+                  counts['unreadable'], counts['repaired'], rate, health))
+            if counts['missing_dirs']:
+                print('    %d directories missing' % counts['missing_dirs'])
+
+        for kind, title in (('file', 'files'), ('segment', 'segments'), ('meta', 'metadata')):
+            statuses = sorted((status, n) for (k, status), n in self.results.items() if k == kind)
+            print('%s: %s' % (title, ', '.join('%d %s' % (n, status) for status, n in statuses) or 'none'))
+        for item, status, detail in sorted(self.problems):
+            print('%s %s: %s' % (status, item, '; '.join(detail)))
+
+        statuses = set(status for item, status, detail in self.problems)
+        if statuses & set(['lost', 'damaged', 'failed']):
+            return 4
+        if 'repaired' in statuses or any(counts['missing_dirs'] for counts in self.health):
+            return 1 if self.repair else 4
+        return 0
+
+if __name__ == '__main__':
+    args = []
+    options = {}
+    memory_limit = MEMORY_LIMIT
+    for arg in sys.argv[1:]:
+        if arg == '--repair':
+            options['repair'] = True
+        elif arg.startswith('--threads='):
+            options['threads'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--state='):
+            options['state'] = arg.split('=', 1)[1]
+        elif arg.startswith('--memory-limit='):
+            memory_limit = parse_size(arg.split('=', 1)[1]) or None
+        else:
+            args.append(arg)
+
+    if len(args) < 2:
+        error('Usage: %s [--raid0|--raid4|--raid5|--ec=K+M] [--repair] [--threads=N] [--state=FILE] [--memory-limit=SIZE] [if raid4/5/ec then KEYPHRASE] [<sub-filesystems>]\n'
+              '(the same store arguments as for mounting, in the same order; the keyphrase is not used,\n'
+              ' pieces are checked and rebuilt as they are stored)' % sys.argv[0])
+
+    fs = Store(args[0], args[1:], memory_limit=memory_limit)
+    try:
+        status = Fsck(fs, **options).run()
+    finally:
+        fs.io.close()
+    sys.exit(status)
@@ -2,19 +2,33 @@
 
 from __future__ import with_statement, print_function
 
+import cStringIO
 import errno
+import json
 import os
 import shutil
 import sys
 import tempfile
+import threading
 import random
 import struct
 
 from fuse import FUSE, FuseOSError, Operations
 
 from utils import *
+from backend import parse_size
+from cache import Hydrator, LocalCache
+from journal import GroupCommit
+from ioengine import wait
+from merkle import MerkleTree, find_mismatch, load_node, parent_dir
+from metacache import MetaCache, bump_generations, read_generation
+from scheduler import ReadScheduler
+from segments import SegmentTable, SegmentWriter, segment_name
+from store import IO_PER_ROOT, MEMORY_LIMIT, Store, encrypted_size
+from writebuffer import WriteBuffer
 
 from Crypto.Cipher import AES
+from Crypto.Util import Counter
 import hashlib
 
 def encrypt_file(key, in_filename, out_filename=None, chunksize=64*1024):
@@ -84,52 +98,184 @@ def decrypt_file(key, in_filename, out_filename=None, chunksize=24*1024):
 
             outfile.truncate(origsize)
 
-# ufspath('foo') = 'foo/.ufs'
-# ufspath('foo', 'bar/baz' = 'foo/.ufs/bar/baz'
-def ufspath(root, path=None):
-    if path is None:
-        return root + '/.ufs'
-    return root + '/.ufs/' + path
-
-# Validate that all paths are directories, contain a .ufs
+# In-memory versions of encrypt_file/decrypt_file for one block, in the
+# same format.
+def encrypt_block(key, data):
+    iv = os.urandom(16)
+    encryptor = AES.new(key, AES.MODE_CBC, iv)
+    padded = data + ' ' * (-len(data) % 16)
+    return struct.pack('<Q', len(data)) + iv + encryptor.encrypt(padded)
+
+def decrypt_block(key, data):
+    origsize = struct.unpack('<Q', data[:struct.calcsize('Q')])[0]
+    start = struct.calcsize('Q') + 16
+    decryptor = AES.new(key, AES.MODE_CBC, data[start-16:start])
+    return decryptor.decrypt(data[start:encrypted_size(data)])[:origsize]
+
+# One-time pad for a raid0 share: AES-CTR under a fresh random key, as
+# unpredictable as os.urandom but generated at cipher speed, a chunk at
+# a time.
+class Keystream(object):
+    def __init__(self):
+        self.cipher = AES.new(os.urandom(32), AES.MODE_CTR, counter=Counter.new(128))
+
+    def read(self, size):
+        return self.cipher.encrypt('\0' * size)
+
+# Split size bytes over stripes in proportion to weights. Returns None
+# when there is nothing to go on (some weight unknown) or the weights are
+# all the same, which means the plain equal split.
+def stripe_sizes(size, weights):
+    if None in weights or len(set(weights)) == 1 or size == 0:
+        return None
+    total = float(sum(weights))
+    sizes = [int(size * w / total) for w in weights]
+    # Hand the rounding leftovers to the heaviest stripes
+    order = sorted(range(len(weights)), key=lambda i: -weights[i])
+    for i in range(size - sum(sizes)):
+        sizes[order[i % len(order)]] += 1
+    return sizes
+
+# Validate that all backends are directories, contain a .ufs
 # directory, and have the same directory contents.
-def validateRootDirs(directories):
-    if not directories:
+#
+# Each root keeps a Merkle tree of its directory structure in .ufs-meta,
+# so this normally costs one small read per root. Roots without one
+# (stores written before it existed) are scanned once and get one.
+def validateRootDirs(backends):
+    if not backends:
         return
 
-    dicts = []
-
     log('Validating directories...')
-    for directory in directories:
-        if not os.path.isdir(directory):
-            error(directory + ' is not a directory')
-        if '.ufs' not in os.listdir(directory):
-            os.mkdir(os.path.join(directory, '.ufs'))
-        ufsdir = ufspath(directory)
-        dicts.append((ufsdir, directory_dict(ufsdir)))
-
-    firstDict = dicts[0]
-    for otherDict in dicts[1:]:
-        if not firstDict[1] == otherDict[1]:
-            error("directory tree mismatch: %s, %s" % (firstDict[0], otherDict[0]))
+    for backend in backends:
+        backend.ensure()
+        if load_node(backend, '') is None:
+            log('No tree hashes in %s, scanning it' % backend.path())
+            MerkleTree().scan(backend.walk(prefetch=4)).save([backend])
+
+    mismatch = find_mismatch(backends)
+    if mismatch is not None:
+        error("directory tree mismatch under '%s': %s" % (mismatch, ', '.join(b.path() for b in backends)))
 
     log('ok.')
 
-class UnifiedCloudStorage(Operations):
-    def __init__(self, raidver, roots):
-        if raidver == '--raid0':
-            self.raid = 0
-            self.roots = roots
-        elif raidver == '--raid4':
-            self.raid = 4
-            self.roots = roots[1:]
-            self.key = hashlib.sha256(roots[0]).digest()
-        else:
-            error('Unrecognized RAID flag: ' + raidver)
-        self.root = tempfile.mkdtemp()
-        #self.roots = roots
+# Files bigger than this are stored in blocks of this size (raid4/5 and
+# ec), see store_blocks.
+BLOCK_SIZE = 4 << 20
+
+# Files up to this size are packed into segments, see segments.py
+PACK_SIZE = 64 << 10
+
+# Segments with less than this share of live data get compacted, checked
+# every COMPACT_INTERVAL seconds and after every flush
+COMPACT_THRESHOLD = 0.5
+COMPACT_INTERVAL = 300
+
+# Writes to an open file are buffered up to this many bytes, see
+# writebuffer.py. 0 turns buffering off.
+WRITE_BUFFER = 8 << 20
+
+# fsyncs that come in within this many seconds of each other are
+# committed to the roots together
+COMMIT_WINDOW = 0.01
+
+# Files fetched back at once after mounting
+HYDRATE_WORKERS = 8
+
+# Where what a mount knows about the store is kept for the next mount of
+# it, see metacache.py. None turns that off.
+META_CACHE = '~/.cache/ucs'
+
+class UnifiedCloudStorage(Store, Operations):
+    def __init__(self, raidver, roots, cache_dir=None, cache_size=None, block_size=BLOCK_SIZE,
+                 pack_size=PACK_SIZE, write_buffer=WRITE_BUFFER, io_per_root=IO_PER_ROOT,
+                 memory_limit=MEMORY_LIMIT, meta_cache=META_CACHE):
+        Store.__init__(self, raidver, roots, io_per_root, memory_limit)
+        self.block_size = block_size
+        self.pack_size = pack_size
+        self.write_buffer = write_buffer
+        self.root = tempfile.mkdtemp(dir=cache_dir)
         log('Created pass-through filesystem at ' + self.root)
 
+        # held is the reservation (from the memory budget) of the file or
+        # block being stored, parts of which go along with its uploads
+        self.held = None
+
+        # md5s of the pieces written by the store in progress, and the
+        # (backend, name) of each, see store()
+        self.sums = {}
+        self.written = set()
+
+        # uploads holds the piece writes of the flush in progress, staged
+        # the (backend, name) of the pieces they write and stale that of
+        # the pieces they make obsolete
+        self.uploads = []
+        self.staged = []
+        self.stale = []
+
+        # What of the temp dir is resident, capped at cache_size bytes,
+        # and the background thread that fetches the rest after mounting
+        self.cache = LocalCache(cache_size)
+        self.hydrator = Hydrator(self._ensure, self.cache.has_room, HYDRATE_WORKERS)
+
+        # FUSE dispatches from many threads at once. self.lock guards the
+        # shared state and whole-tree operations (init/destroy, renames);
+        # file data is guarded per inode.
+        self.lock = threading.RLock()
+        self.inode_locks = LockStripes()
+
+        # self.dirty holds the files already journaled as written since
+        # the last apply of the journal.
+        self.dirty = set()
+        # The new names of what was renamed since the last apply: the
+        # roots only have it under the old ones, so it stays resident
+        self.renamed = set()
+        self.committer = GroupCommit(self._commit, COMMIT_WINDOW)
+
+        # Which blocks of each dirty file were written to, None when the
+        # whole file has to go (new files)
+        self.dirty_blocks = {}
+
+        # Writes not yet made to the temp dir, per open handle
+        self.write_buffers = {}
+
+        # Picks the fastest pieces to read back, hedging slow roots
+        self.scheduler = ReadScheduler(io=self.io)
+
+        # Merkle hashes of the temp dir's tree, mirrored to every root
+        self.merkle = MerkleTree(self.root)
+
+        # Live data of the segments small files are packed into, and the
+        # background thread that compacts them
+        self.segments = SegmentTable(self.backends, self.io)
+        self.compact_wakeup = threading.Event()
+        self.compactor = None
+        self.stopping = False
+
+        # What the last mount of this store knew, kept locally, and the
+        # generations of the roots it is checked against; bumped is set
+        # once they have been bumped since the cache was last saved
+        identity = '\0'.join([raidver, getattr(self, 'key', '')] + [repr(backend) for backend in self.backends])
+        self.metacache = MetaCache(meta_cache, identity) if meta_cache else None
+        self.generations = None
+        self.bumped = False
+
+    # Lock for the inode behind path (or an open fh). Paths that do not
+    # exist yet are striped by name instead.
+    def _inode_lock(self, path=None, fh=None):
+        try:
+            if fh is not None:
+                return self.inode_locks(os.fstat(fh).st_ino)
+            return self.inode_locks(os.lstat(self._full_path(path)).st_ino)
+        except OSError:
+            return self.inode_locks(path)
+
+    # The lock fetching path back and evicting it take. It is keyed by
+    # path rather than inode, as both replace the file and its inode
+    # with it; an evicted file has no other links (see _evict).
+    def _fetch_lock(self, path):
+        return self.inode_locks(path)
+
     def _full_path(self, partial):
         if partial.startswith("/"):
             partial = partial[1:]
@@ -141,112 +287,691 @@ class UnifiedCloudStorage(Operations):
     def create(self, path, mode, fi=None):
         log('CREATE ' + path)
         full_path = self._full_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        with self.lock:
+            self._mark_dirty(path)
+            self.dirty_blocks[path] = None
+            fh = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+            self.cache.touch(path, 0)
+            self.cache.pin(path)
+            return fh
+
+    def _mark_dirty(self, path):
+        if path not in self.dirty:
+            self._journal('write', path)
+            self.dirty.add(path)
+
+    # Bytes [start, end) of path changed
+    def _dirty_range(self, path, start, end):
+        with self.lock:
+            blocks = self.dirty_blocks.setdefault(path, set())
+            if blocks is not None:
+                blocks.update(range(start / self.block_size,
+                                    (end + self.block_size - 1) / self.block_size))
+
+    # Bytes [start, end) of path were written to the temp dir. Files are
+    # only marked dirty once their new contents are there, so that a
+    # commit running meanwhile either uploads the change or leaves the
+    # file dirty for the next one.
+    def _written(self, path, start, end):
+        with self.lock:
+            self._mark_dirty(path)
+            self._dirty_range(path, start, end)
+
+    # Make buffered writes to path's inode (or to all files) before
+    # something looks at the temp dir copy
+    def _flush_writes(self, path=None):
+        if not self.write_buffers:
+            return
+        if path is not None:
+            try:
+                ino = os.lstat(self._full_path(path)).st_ino
+            except OSError:
+                return
+        with self.lock:
+            buffers = [buf for buf in self.write_buffers.values() if path is None or buf.ino == ino]
+        for buf in buffers:
+            with self._inode_lock(fh=buf.fh):
+                buf.flush()
 
     def destroy(self, path):
+        log('DESTROY ' + path)
+        self.hydrator.stop()
+        self._flush_writes()
+        if self.compactor is not None:
+            self.stopping = True
+            self.compact_wakeup.set()
+            self.compactor.join()
+        self._apply_fetched()
+        with self.lock:
+            self._save_metacache()
+        self.io.close()
+
+    # Apply the journal under self.lock, once the dirty files it stores
+    # whole are all here. Those not fetched back yet are fetched first,
+    # without self.lock: _ensure takes the fetch lock, which comes before
+    # it.
+    def _apply_fetched(self):
+        while True:
+            with self.lock:
+                evicted = [path for path in self.dirty if self.cache.is_evicted(path)
+                           and self._stored_whole(os.path.getsize(self._full_path(path)))]
+                if not evicted:
+                    self.apply_journal()
+                    return
+            for path in evicted:
+                self._ensure(path)
+
+    # Whether store writes a file of size bytes whole, rather than in
+    # blocks
+    def _stored_whole(self, size):
+        return self.raid == 0 or size <= self.block_size
+
+    # Bring the roots up to date with the temp dir by replaying the
+    # journal tail onto them. Renames and deletes are done to the stored
+    # pieces in place on every root; only files whose contents changed
+    # are re-uploaded, once each, however many times they were written.
+    #
+    # New pieces are staged on every root first. Only once all of them
+    # are there does a commit record go into the journal with the
+    # manifest and segment table that describe them, and the pieces are
+    # moved into place and the ones they replace removed; a crash before
+    # that leaves the stored version as it was, and one after it is
+    # finished by replaying the commit (see _finish). Renames journal a
+    # cleared record once the pieces of the file they replace are gone,
+    # so that replaying them never removes the file they moved.
+    #
+    # While recovering the temp dir is still empty, so the tree hashes are
+    # left alone until init has rebuilt it.
+    def apply_journal(self, recovering=False):
+        records = self.journal.pending()
+        if not records:
+            return
+        self._changing()
+
+        cleared = set(int(record['args'][0]) for record in records if record['op'] == 'cleared')
+        uploads = set()
+        dirs = set()
+        for record in records:
+            op, args = record['op'], record['args']
+            if op == 'cleared':
+                continue
+            if op == 'commit':
+                log('replaying %d: commit' % record['seq'])
+                self._finish(json.loads(args[0]))
+                continue
+            if op != 'truncate':
+                for arg in args[:2 if op == 'rename' else 1]:
+                    dirs.add(parent_dir(arg))
+            log('replaying %d: %s %s' % (record['seq'], op, ' '.join(args)))
+            if op == 'mkdir':
+                def mkdir(backend):
+                    if not backend.isdir(args[0]):
+                        backend.mkdir(args[0])
+                self.io.each(self.backends, mkdir)
+            elif op == 'rmdir':
+                def rmdir(backend):
+                    if backend.isdir(args[0]):
+                        backend.rmdir(args[0])
+                self.io.each(self.backends, rmdir)
+            elif op == 'rename':
+                old, new = args
+                self.rename_pieces(old, new, record['seq'], record['seq'] in cleared)
+                for filename in list(uploads):
+                    if filename == old or filename.startswith(old + '/'):
+                        uploads.remove(filename)
+                        uploads.add(new + filename[len(old):])
+            elif op == 'unlink':
+                self.remove_pieces(args[0])
+                uploads.discard(args[0])
+            else:
+                # write, truncate, link, symlink, mknod: new contents
+                uploads.add(args[0])
+
+        if recovering:
+            # Staged by flushes that never got to commit
+            self.io.each(self.backends, lambda backend: backend.clear_staged())
+
+        # Files are read and encoded one after the other while their pieces
+        # go out behind them, as fast as the roots take them. Segments are
+        # written out as they fill up their share of the memory budget.
+        segment = SegmentWriter(self.backends, self.io, self.memory)
+        self.uploads = []
+        self.staged = []
+        self.stale = []
+        try:
+            for filename in sorted(uploads):
+                if os.path.isfile(self._full_path(filename)):
+                    self.store(filename, self.dirty_blocks.get('/' + filename), segment)
+                else:
+                    log('contents of %s were lost, keeping the stored version' % filename)
+                if self.memory.limit is not None and sum(segment.sizes) > self.memory.limit / 8:
+                    self._write_segment(segment)
+                    segment = SegmentWriter(self.backends, self.io, self.memory)
+            if segment.files:
+                self._write_segment(segment)
+        finally:
+            segment.drop()
+            pending, self.uploads = self.uploads, []
+            wait(pending)
+
+        index = dict((backend, i) for i, backend in enumerate(self.backends))
+        commit = {'staged': [[index[backend], name] for backend, name in self.staged],
+                  'stale': [[index[backend], name] for backend, name in self.stale],
+                  'manifest': self.manifest.changes(), 'segments': self.segments.changes()}
+        self.staged, self.stale = [], []
+        self.journal.append('commit', json.dumps(commit))
+        self._finish(commit)
+        if not recovering:
+            changed, removed = self.merkle.update(dirs)
+            self.merkle.save(self.backends, changed, removed, self.io)
+
+        self.journal.checkpoint(self.journal.seq)
+        self.dirty.clear()
+        self.renamed.clear()
+        self.dirty_blocks.clear()
+
+    # Make what a commit record describes so: move its staged pieces into
+    # place, save its manifest shards and segment table, and only then
+    # remove the pieces they replaced. Doing it again changes nothing.
+    def _finish(self, commit):
+        def promote(backend):
+            i = self.backends.index(backend)
+            for n, name in commit['staged']:
+                if n == i:
+                    backend.promote(name)
+        self.io.each(self.backends, promote)
+        self.manifest.redo(commit['manifest'])
+        if commit['segments'] is not None:
+            self.segments.redo(commit['segments'])
+        self.manifest.save()
+        self.segments.save()
+
+        def remove(backend, name):
+            try:
+                backend.remove(name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        stale = [(self.backends[n], name) for n, name in commit['stale']]
+        for backend, name in stale:
+            log('Removing ' + backend.path(name))
+        wait([self.io.submit(backend, remove, backend, name, retry=False) for backend, name in stale])
+
+    # Write out the segment small files were packed into, and record
+    # where they went
+    def _write_segment(self, segment):
+        for filename, location in segment.write().items():
+            self.manifest.set(filename, dict(self.manifest.get(filename) or {}, packed=location))
+        self.segments.add(segment.sid, sum(segment.sizes),
+                          dict((filename, segment.size_of(filename)) for filename in segment.files))
+        self.compact_wakeup.set()
+
+    # Record a metadata operation before doing it.
+    def _journal(self, op, *args):
+        self.journal.append(op, *[arg.lstrip('/') for arg in args])
+
+    def _stored_names(self, backend, filename):
         if self.raid == 0:
-            self.destroy_raid0(path)
-        elif self.raid == 4:
-            self.destroy_raid4(path)
+            return [filename] if backend.isfile(filename) else []
+        return backend.pieces(filename)
+
+    def remove_pieces(self, filename):
+        record = self.manifest.get(filename)
+        if record and 'packed' in record:
+            self.segments.release(record['packed']['segment'], filename)
+        self.manifest.remove(filename)
+        def remove(backend):
+            for piece in self._stored_names(backend, filename):
+                log('Removing ' + backend.path(piece))
+                backend.remove(piece)
+        self.io.each(self.backends, remove)
+
+    # Rename old's pieces to new on every root. seq is the journal record
+    # of the rename; cleared says a replay of it got as far as removing
+    # the pieces of the file it replaces, and may have moved some of
+    # old's pieces to new since.
+    def rename_pieces(self, old, new, seq=None, cleared=False):
+        # Renaming onto a file replaces it: none of its pieces may stay
+        # behind next to the ones moved in
+        if new != old and not cleared:
+            self.remove_pieces(new)
+            if seq is not None:
+                self.journal.append('cleared', str(seq))
+        self.manifest.rename(old, new, self.merkle.nodes.keys())
+        self.segments.rename(old, new)
+        def rename(backend):
+            if backend.isdir(old):
+                backend.rename(old, new)
+                return
+            for piece in self._stored_names(backend, old):
+                log('Renaming %s to %s' % (backend.path(piece), new + piece[len(old):]))
+                backend.rename(piece, new + piece[len(old):])
+        self.io.each(self.backends, rename)
+
+    # Write filename's pieces to the roots, replacing what was there.
+    # blocks are the blocks that changed if it is stored in blocks (None
+    # if unknown). Small files go into segment instead of files of their
+    # own if there is one. The pieces that are no longer used are only
+    # removed once the new ones are written, see _queue_stale.
+    #
+    # The record gets the md5 of every piece written, for ucs-fsck to
+    # check them against: {suffix: md5}, keyed by what the piece name
+    # adds to the file name ('.1.4.b7') so that renames keep them valid.
+    # raid0 stores every share under the file name itself, and records
+    # a list of md5s in root order instead.
+    def store(self, filename, blocks=None, segment=None):
+        st = os.stat(self._full_path(filename))
+        self.sums = {}
+        self.written = set()
+        start = self.file_rotation(filename)
+        if not self._stored_whole(st.st_size):
+            self.manifest.set(filename, dict(self.manifest.get(filename) or {}, rotation=start))
+            self.store_blocks(filename, blocks)
         else:
-            error('NOT REACHED')
-
-    def destroy_raid0(self, path):
-        def on_file(root, filename):
-            full_path = self._full_path(filename)
-            contents = open(full_path, 'r').read()
-
-            random_bits = []
-            for directory in self.roots[1:]:
-                ufs_path = ufspath(directory, filename)
-                bits = os.urandom(len(contents))
-
-                with open(ufs_path, 'w') as handle:
-                    log('Writing ' + ufs_path)
-                    handle.write(bits)
-
-                random_bits.append(bits)
-
-            ufs_path = ufspath(self.roots[0], filename)
-            with open(ufs_path, 'w') as handle:
-                log('Writing ' + ufs_path)
-                handle.write(xor_strings(contents, *random_bits))
-
-        def on_dir(dirname):
-            for directory in self.roots:
-                ufs_path = ufspath(directory, dirname)
-                log('Making ' + ufs_path)
-                os.mkdir(ufs_path)
-
-        # Delete roots' files, re-build from scratch
-        for directory in self.roots:
-            ufs_path = ufspath(directory)
-            log('Removing ' + ufs_path)
-            shutil.rmtree(ufs_path)
-            os.mkdir(ufs_path)
-
-        traverse(self.root, on_file, on_dir)
-
-    def destroy_raid4(self, path):
-        def on_file(root, filename):
-            full_path = self._full_path(filename)
-            encrypt_file(self.key, full_path, full_path + ".enc")
-            os.remove(full_path)
-            contents = open(full_path + ".enc", 'r').read()
+            if st.st_size > self.pack_size:
+                segment = None
+
+            # Needs all of it locally, fetched back before apply_journal
+            # took self.lock (see _apply_fetched)
+            self._unpack(filename)
+            self.manifest.set(filename, {'rotation': start})
+            if self.raid == 0:
+                self.store_raid0(filename, segment)
+            elif self.raid in (4, 5):
+                with self.memory.hold(self._coding_cost(st.st_size)) as self.held:
+                    self.store_raid4(filename, segment)
+            elif self.raid == 'ec':
+                with self.memory.hold(self._coding_cost(st.st_size)) as self.held:
+                    self.store_ec(filename, segment)
+            else:
+                error('NOT REACHED')
+            self._queue_stale(filename, lambda name: False)
 
-            num_roots = len(self.roots)
+        # Enough to put a placeholder in its place on the next mount
+        record = self.manifest.get(filename) or {}
+        if isinstance(self.sums, list):
+            sums = self.sums
+        else:
+            sums = dict(record.get('sums') or {})
+            for name, digest in self.sums.items():
+                sums[name[len(filename):]] = digest
+        self.manifest.set(filename, dict(record, size=st.st_size, mtime=st.st_mtime, sums=sums))
+
+    # filename no longer lives in the segment its record points to
+    def _unpack(self, filename):
+        record = self.manifest.get(filename)
+        if record and 'packed' in record:
+            self.segments.release(record['packed']['segment'], filename)
+            self.manifest.set(filename, dict((key, value) for key, value in record.items() if key != 'packed'))
+
+    # Queue the stored pieces of filename that the store in progress
+    # made obsolete, for apply_journal to remove once the new ones are
+    # written: copies of what it wrote that are on other roots, and the
+    # names used(name) says are no longer part of the file.
+    def _queue_stale(self, filename, used):
+        names = set(name for backend, name in self.written)
+        listings = self.io.each(self.backends, lambda backend: self._stored_names(backend, filename))
+        for backend, listing in zip(self.backends, listings):
+            for name in listing:
+                if (backend, name) in self.written:
+                    continue
+                if name in names or not used(name):
+                    self.stale.append((backend, name))
+
+    # Write one piece of filename to backend, as a file of its own or
+    # into segment.
+    def _write_piece(self, filename, backend, name, data, segment=None):
+        if segment is not None:
+            self.sums[name] = hashlib.md5(data).hexdigest()
+            segment.add(filename, backend, name, data)
+        else:
+            self._upload(backend, name, data)
+
+    # Write a piece in the background; apply_journal waits for it before
+    # the manifest says it is there. The piece's share of what was held
+    # for it goes along and is given back once it is written.
+    def _upload(self, backend, name, data):
+        hold = self.held.take(len(data)) if self.held is not None else 0
+        self.sums[name] = hashlib.md5(data).hexdigest()
+        self.written.add((backend, name))
+        self.staged.append((backend, name))
+        self.uploads.append(self.io.submit(backend, backend.write_staged, name, data, size=len(data), hold=hold))
+
+    # Roughly the memory it takes to encode or decode size bytes: the
+    # encrypted copy, its pieces, their padded copies and the redundancy
+    def _coding_cost(self, size):
+        k = self.rs.k if self.raid == 'ec' else max(1, len(self.backends) - 1)
+        return 3 * size + size * (len(self.backends) - k) / k
+
+    # Every root but the first gets a random pad, the first gets the file
+    # xored with all of them. The pads are keystreams, streamed to the
+    # roots in step with the file so memory use stays constant.
+    def store_raid0(self, filename, segment=None, chunksize=1 << 20):
+        full_path = self._full_path(filename)
+        pads = [Keystream() for backend in self.backends[1:]]
+        sums = [hashlib.md5() for backend in self.backends]
+
+        for backend in self.backends:
+            log('Writing ' + backend.path(filename))
+        if segment is None:
+            outputs = [backend.throttle.call(backend.open_staged, (filename,)) for backend in self.backends]
+            self.written.update((backend, filename) for backend in self.backends)
+            self.staged.extend((backend, filename) for backend in self.backends)
+        else:
+            outputs = [cStringIO.StringIO() for backend in self.backends]
 
+        try:
+            with open(full_path, 'rb') as source, self.memory.hold(chunksize * (len(self.backends) + 1)):
+                while True:
+                    chunk = source.read(chunksize)
+                    if len(chunk) == 0:
+                        break
+                    random_bits = [pad.read(len(chunk)) for pad in pads]
+                    shares = [xor_bytes(chunk, *random_bits)] + random_bits
+                    for backend, output, digest, share in zip(self.backends, outputs, sums, shares):
+                        if segment is None:
+                            # A write that failed halfway cannot be retried
+                            backend.throttle.call(output.write, (share,), size=len(share), retry=False)
+                        else:
+                            output.write(share)
+                        digest.update(share)
+        finally:
+            if segment is None:
+                for output in outputs:
+                    output.close()
+
+        if segment is not None:
+            for backend, output in zip(self.backends, outputs):
+                self._write_piece(filename, backend, filename, output.getvalue(), segment)
+        self.sums = [digest.hexdigest() for digest in sums]
+
+    def _encrypted(self, filename):
+        full_path = self._full_path(filename)
+        encrypt_file(self.key, full_path, full_path + ".enc")
+        contents = open(full_path + ".enc", 'r').read()
+        os.remove(full_path + ".enc")
+        return contents
+
+    def store_raid4(self, filename, segment=None):
+        sizes = self.write_stripes(filename, self._encrypted(filename), segment=segment)
+        if sizes is not None:
+            self.manifest.set(filename, dict(self.manifest.get(filename), chunks=sizes))
+
+    # Stripe contents over the backends with an xor parity piece. Returns
+    # the stripe sizes if they were weighted, None for an equal split.
+    def write_stripes(self, filename, contents, block=None, segment=None):
+        backends = self.placement(filename, block)
+        num_roots = len(backends)
+
+        sizes = stripe_sizes(len(contents), [b.weight() for b in backends[1:]])
+        weighted = sizes is not None
+        if not weighted:
             # 3 roots means split into 2 pieces: each piece is (x+1)/2 bytes long
             chunk_size = (len(contents) + num_roots-2) / (num_roots-1)
-            chunks = []
-            for i in range(1, num_roots):
-                fromIndex = 0 + (i-1)*chunk_size
-                toIndex = fromIndex + chunk_size
-                chunk = contents[fromIndex:toIndex]
-                chunks.append(chunk)
-
-                dest_file = ufspath(self.roots[i], '%s.%s.%s' % (filename, i, num_roots-1))
-                with open(dest_file, 'w') as handle:
-                    log('writing %s[%d:%d] to %s' % (filename, fromIndex, toIndex, dest_file))
-                    handle.write(chunk)
-
-            # Pad last chunk with extra 0s
-            padding = len(chunks[0]) - len(chunks[-1])
-            log('Padding last chunk with %d bytes for xor' % padding)
-            chunks[-1] = chunks[-1] + '\0' * padding
-
-            dest_file = ufspath(self.roots[0], '%s.xor%d.%s' % (filename, padding, num_roots-1))
-            with open(dest_file , 'w') as handle:
-                log('writing %s' % dest_file)
-                handle.write(xor_strings(*chunks))
-
-        def on_dir(dirname):
-            for directory in self.roots:
-                ufs_path = ufspath(directory, dirname)
-                log('Making ' + ufs_path)
-                os.mkdir(ufs_path)
-
-        log('DESTROY ' + path)
-
-        # Delete roots' files, re-build from scratch
-        for directory in self.roots:
-            ufs_path = ufspath(directory)
-            log('Removing ' + ufs_path)
-            shutil.rmtree(ufs_path)
-            os.mkdir(ufs_path)
-
-        traverse(self.root, on_file, on_dir)
+            sizes = [chunk_size] * (num_roots-1)
+        else:
+            log('striping %s as %s' % (filename, sizes))
+
+        chunks = []
+        fromIndex = 0
+        for i in range(1, num_roots):
+            toIndex = fromIndex + sizes[i-1]
+            chunk = contents[fromIndex:toIndex]
+            chunks.append(chunk)
+
+            dest_file = RawFilePiece(filename, i, num_roots-1, block).path()
+            log('writing %s[%d:%d] to %s' % (filename, fromIndex, toIndex, backends[i].path(dest_file)))
+            self._write_piece(filename, backends[i], dest_file, chunk, segment)
+            fromIndex = toIndex
+
+        # Pad chunks with extra 0s up to the longest one
+        longest = max(len(chunk) for chunk in chunks)
+        padding = longest - len(chunks[-1])
+        log('Padding last chunk with %d bytes for xor' % padding)
+        chunks = [chunk + '\0' * (longest - len(chunk)) for chunk in chunks]
+
+        dest_file = XorFilePiece(filename, padding, num_roots-1, block).path()
+        log('writing %s' % backends[0].path(dest_file))
+        self._write_piece(filename, backends[0], dest_file, xor_bytes(*chunks), segment)
+
+        return sizes if weighted else None
+
+    def store_ec(self, filename, segment=None):
+        self.write_shards(filename, self._encrypted(filename), segment=segment)
+
+    def write_shards(self, filename, contents, block=None, segment=None):
+        # k equal shards, the last one padded with 0s; the padding is cut
+        # off again by encrypted_size() when reading back
+        k = self.rs.k
+        shard_size = (len(contents) + k-1) / k
+        contents += '\0' * (shard_size*k - len(contents))
+        shards = [contents[i*shard_size:(i+1)*shard_size] for i in range(k)]
+
+        backends = self.placement(filename, block)
+        for i, shard in enumerate(shards + self.rs.encode(shards)):
+            dest_file = RsFilePiece(filename, i, self.rs.k, self.rs.m, block).path()
+            log('writing %s' % backends[i].path(dest_file))
+            self._write_piece(filename, backends[i], dest_file, shard, segment)
+
+    # Files bigger than a block are stored block by block, each block
+    # encrypted on its own, so a change only rewrites the blocks it
+    # touched and a read only needs the blocks it covers. In ec mode each
+    # block is erasure coded across the roots; raid4/5 lay the blocks out
+    # in rows (see write_rows). The manifest holds the block map: the
+    # file size, the block size, the blocks per row, a slot per block and
+    # the md5 of every block as it was stored.
+    #
+    # Blocks are only stored again if their md5 changed, so a file that
+    # was rewritten whole (saved over, recreated, replaced by a rename)
+    # costs no more than the blocks that actually differ.
+    def store_blocks(self, filename, blocks=None):
+        full_path = self._full_path(filename)
+        size = os.path.getsize(full_path)
+        count = (size + self.block_size - 1) / self.block_size
+        rows = self.raid != 'ec'
+
+        record = self.manifest.get(filename)
+        if not record or record.get('block_size') != self.block_size or rows != ('row' in record):
+            self._unpack(filename)
+            old_count = 0
+            blocks = set(range(count))
+        else:
+            old_count = len(record['blocks'])
+            if blocks is None:
+                # Not known what was written: the md5s will tell
+                blocks = range(count)
+            # Blocks past the old end are new, whatever was written
+            blocks = set(b for b in blocks if b < count) | set(range(old_count, count))
+
+        sigs = list(record.get('sigs') or []) if old_count else []
+        sigs = (sigs + [None] * count)[:count]
+        unchanged = 0
+        with open(full_path, 'rb') as source:
+            for block in sorted(blocks):
+                sig = hashlib.md5(pread(source.fileno(), self.block_size, block * self.block_size)).hexdigest()
+                if sig == sigs[block]:
+                    blocks.discard(block)
+                    unchanged += 1
+                sigs[block] = sig
+        if unchanged:
+            log('%d blocks of %s are unchanged' % (unchanged, filename))
+
+        log('storing blocks %s of %s' % (sorted(blocks), filename))
+        if rows:
+            self.write_rows(filename, blocks, old_count, count)
+        else:
+            with open(full_path, 'rb') as source:
+                for block in sorted(blocks):
+                    with self.memory.hold(self._coding_cost(self.block_size)) as self.held:
+                        data = pread(source.fileno(), self.block_size, block * self.block_size)
+                        self.write_shards(filename, encrypt_block(self.key, data), block)
+
+        # Whatever is not a block (or row parity) of the file as it is
+        # now goes, like the pieces of a file stored whole before
+        per_row = len(self.backends) - 1
+        def used(name):
+            piece = fileToFilePiece(name)
+            if piece.block is None:
+                return False
+            if rows and piece.typ == 'xor':
+                return piece.block * per_row < count
+            return piece.block < count
+        self._queue_stale(filename, used)
+
+        # The sums of the blocks that were not rewritten stay
+        sums = {}
+        if old_count:
+            for suffix, digest in (record.get('sums') or {}).items():
+                if fileToFilePiece(filename + suffix).block < count:
+                    sums[suffix] = digest
+        record = {'size': size, 'block_size': self.block_size, 'blocks': [None] * count,
+                  'sums': sums, 'sigs': sigs, 'rotation': self.file_rotation(filename)}
+        if rows:
+            record['row'] = len(self.backends) - 1
+        self.manifest.set(filename, record)
+
+    # raid4/5 files stored in blocks are laid out like the disks of a
+    # RAID array: every block is stored whole on one root, and each row of
+    # n-1 blocks gets an xor parity block on the remaining root (rotated
+    # per row in raid5). Changing a block then means a read-modify-write
+    # of its row's parity,
+    #
+    #   new parity = old parity ^ old block ^ new block
+    #
+    # which costs two reads and two writes however big the file is. Rows
+    # that are new, or entirely rewritten, get their parity computed
+    # directly. A crash between writing a block and its parity leaves
+    # the row out of step with the md5s the manifest still has for it;
+    # replaying the journal cannot fix that (the local copy is gone),
+    # but ucs-fsck finds it. The pieces always go to the roots the row
+    # already lives on, see placement.
+    def write_rows(self, filename, blocks, old_count, count):
+        full_path = self._full_path(filename)
+        per_row = len(self.backends) - 1
+        # Blocks cut off by a truncate change to nothing
+        changed = set(blocks) | set(range(count, old_count))
+        pieces = self.file_pieces(filename) if old_count else {}
+
+        with open(full_path, 'rb') as source:
+            for row in sorted(set(block / per_row for block in changed)):
+                with self.memory.hold(self._coding_cost(per_row * self.block_size)) as self.held:
+                    first = row * per_row
+                    members = range(first, min(first + per_row, max(count, old_count)))
+                    backends = self.placement(filename, row)
+                    parity_name = XorFilePiece(filename, 0, per_row, row).path()
+
+                    new = {}
+                    for block in members:
+                        if block in changed and block < count:
+                            data = pread(source.fileno(), self.block_size, block * self.block_size)
+                            new[block] = encrypt_block(self.key, data)
+                        elif block in changed:
+                            new[block] = ''
+
+                    if first >= count:
+                        parity = None
+                    elif all(block in new for block in members if block < count):
+                        parity = [new[block] for block in members if block < count]
+                    else:
+                        # Read back what is being replaced, and the parity
+                        name = '%s row %d' % (filename, row)
+                        replaced = [block - first + 1 for block in new if block < old_count]
+                        old = self.read_row(name, self.row_pieces(pieces, row, per_row, old_count),
+                                            [0] + [block - first + 1 for block in members if block < old_count],
+                                            [0] + replaced)
+                        if old is None:
+                            raise IOError(errno.EIO, 'cannot update the parity of ' + name)
+                        parity = old.values() + new.values()
+                        log('updating parity of %s in place (blocks %s)' % (name, sorted(new)))
+
+                    # Blocks cut off, and the parity of rows that are
+                    # gone, are left to store_blocks to remove
+                    for block in sorted(new):
+                        if block >= count:
+                            continue
+                        dest_file = RawFilePiece(filename, block - first + 1, per_row, block).path()
+                        backend = backends[block - first + 1]
+                        log('writing %s block %d to %s' % (filename, block, backend.path(dest_file)))
+                        self._upload(backend, dest_file, new[block])
+
+                    if parity is None:
+                        continue
+                    longest = max(len(p) for p in parity)
+                    log('writing %s' % backends[0].path(parity_name))
+                    self._upload(backends[0], parity_name, xor_bytes(*[p + '\0' * (longest - len(p)) for p in parity]))
+
+    # {numer: piece} of one row of a file stored in rows, from pieces
+    # grouped as file_pieces() does. The parity is 0.
+    def row_pieces(self, pieces, row, per_row, count):
+        found = {}
+        if 0 in pieces.get(row, {}):
+            found[0] = pieces[row][0]
+        for block in range(row * per_row, min((row + 1) * per_row, count)):
+            numer = block - row * per_row + 1
+            if numer in pieces.get(block, {}):
+                found[numer] = pieces[block][numer]
+        return found
+
+    # Read the wanted members (numers, parity 0) of one row, each from its
+    # own piece if it can be, else reconstructed as the xor of all the
+    # other members. Returns {numer: data}, or None.
+    def read_row(self, name, pieces, members, wanted):
+        # When all but one member is wanted, that one can stand in for
+        # a slow or missing one
+        spare = [n for n in members if n not in wanted]
+        candidates = dict((n, pieces[n]) for n in wanted + (spare if len(spare) == 1 else [])
+                          if n in pieces)
+        got = self.scheduler.fetch(candidates, len(wanted))
+        missing = [n for n in wanted if n not in got]
+        if len(missing) > 1:
+            log('could not read enough pieces to recover ' + name)
+            return None
+
+        if missing:
+            lost = missing[0]
+            log("didn't find piece %d of %s: reconstructing it now" % (lost, name))
+            rest = dict((n, pieces[n]) for n in members if n not in got and n != lost and n in pieces)
+            if rest:
+                got.update(self.scheduler.fetch(rest, len(rest)))
+            others = [got.get(n) for n in members if n != lost]
+            if None in others:
+                log('could not read enough pieces to recover ' + name)
+                return None
+            longest = max(len(data) for data in others)
+            rebuilt = xor_bytes(*[data + '\0' * (longest - len(data)) for data in others])
+            got[lost] = rebuilt if lost == 0 else rebuilt[:encrypted_size(rebuilt)]
+
+        return dict((n, got[n]) for n in wanted)
 
     def flush(self, path, fh):
         log('FLUSH ' + path)
-        return os.fsync(fh)
-
+        with self._inode_lock(fh=fh):
+            buf = self.write_buffers.get(fh)
+            if buf is not None:
+                buf.flush()
+            return os.fsync(fh)
+
+    # Unlike flush, fsync does not return before the file is on the
+    # roots: the whole journal is applied, for every fsync that came in
+    # at about the same time at once.
     def fsync(self, path, fdatasync, fh):
         log('FSYNC ' + path)
-        return self.flush(path, fh)
+        self.flush(path, fh)
+        try:
+            self.committer.wait()
+        except (IOError, OSError) as e:
+            log('committing %s to the roots failed: %s' % (path, e))
+            raise FuseOSError(errno.EIO)
+
+    def _commit(self):
+        self._apply_fetched()
+        # What was committed can be evicted now
+        self._evict()
 
     def getattr(self, path, fh=None):
         log('GETATTR ' + path)
+        self.hydrator.bump(path)
+        self._flush_writes(path)
         full_path = self._full_path(path)
         st = os.lstat(full_path)
         return dict((key, getattr(st, key)) for key in
@@ -261,155 +986,691 @@ class UnifiedCloudStorage(Operations):
             ))
 
     def init(self, path):
-        if self.raid == 0:
-            self.init_raid0(path)
-        elif self.raid == 4:
-            self.init_raid4(path)
-        else:
-            error('NOT REACHED')
+        with self.lock:
+            def prepare(backend):
+                backend.ensure()
+                return read_generation(backend)
+            self.generations = self.io.each(self.backends, prepare)
+
+            # Finish whatever a crashed session left in the journal
+            # before reading the roots back. Otherwise, if nothing has
+            # changed on the roots since the last mount, the tree is
+            # put back the way it left it.
+            state = None
+            if self.journal.load():
+                log('Recovering from journal...')
+                self.apply_journal(recovering=True)
+            elif self.metacache is not None:
+                state = self.metacache.load(self.generations)
+
+            if state is not None:
+                self.init_cached(path, state)
+            else:
+                if self.raid == 0:
+                    self.init_raid0(path)
+                elif self.raid in (4, 5):
+                    self.init_raid4(path)
+                elif self.raid == 'ec':
+                    self.init_ec(path)
+                else:
+                    error('NOT REACHED')
+
+                # From here on the tree hashes are kept up to date on
+                # every flush; roots whose stored hash is stale get the
+                # full tree.
+                self.merkle.scan(walk(self.root))
+                nodes = self.io.each(self.backends, lambda backend: load_node(backend, ''))
+                stale = [backend for backend, node in zip(self.backends, nodes)
+                         if node is None or node['hash'] != self.merkle.root_hash()]
+                if stale:
+                    self._changing()
+                    self.merkle.save(stale, io=self.io)
+                self._save_metacache()
+
+        self.hydrator.start()
+
+        self.compactor = threading.Thread(target=self._compact_loop)
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    # Put the tree back the way the metadata cache has it, without asking
+    # the roots: directories, placeholders for the files, and the
+    # manifest shards, segment table and tree hashes the last mount had.
+    def init_cached(self, path, state):
+        log('INIT: %s (from %s)' % (path, self.metacache.path))
+        self.manifest.preload(state['manifest'])
+        if state['segments'] is not None:
+            self.segments.preload(state['segments'])
+        self.merkle.nodes = state['merkle']
+        for dirname in state['dirs']:
+            self._make_dir(dirname)
+        for filename, (size, mtime) in state['files'].items():
+            self._placeholder(filename, size, mtime)
+        log('%d directories and %d files, the roots were not scanned' % (len(state['dirs']), len(state['files'])))
+
+    # Save what this mount knows about the store for the next one, once
+    # the roots and the temp dir agree (after init, and at unmount after
+    # the last flush).
+    def _save_metacache(self):
+        if self.metacache is None:
+            return
+        dirs = []
+        files = {}
+        for relpath, entry, st in walk(self.root, with_stat=True):
+            if entry.is_dir():
+                dirs.append(relpath)
+            else:
+                files[relpath] = [st.st_size, st.st_mtime]
+        self.metacache.save(self.generations, {'dirs': dirs, 'files': files,
+                                               'manifest': self.manifest.loaded(),
+                                               'segments': self.segments.loaded(),
+                                               'merkle': self.merkle.nodes})
+        # The next change has to invalidate what was just saved
+        self.bumped = False
+
+    # The roots are about to change: bump their generations first (once
+    # until the cache is saved again), so that no metadata cache saved
+    # before matches them any more, even if this mount never gets to
+    # save its own.
+    def _changing(self):
+        with self.lock:
+            if not self.bumped:
+                self.generations = bump_generations(self.backends, self.generations, self.io)
+                self.bumped = True
 
     def init_raid0(self, path):
         def on_file(root, filename):
-            # xor all files together
-            contents = open(ufspath(self.roots[0], filename), 'r').read()
-            for next_root in self.roots[1:]:
-                with open(ufspath(next_root, filename), 'r') as handle:
-                    next_contents = handle.read()
+            record = self.manifest.get(filename) or {}
+            if 'packed' not in record:
+                record = dict(record, size=self.backends[0].getsize(filename))
+            self._restore(filename, record)
 
-                    if len(contents) != len(next_contents):
-                        error('Corrupt data: len(%s) != len (%s) (%d != %d)'
-                                % (ufspath(self.roots[0], filename),
-                                    ufspath(next_root, filename),
-                                    len(contents),
-                                    len(next_contents)))
+        dirs = set([''])
+        def on_dir(dirname):
+            self._make_dir(dirname)
+            dirs.add(dirname)
 
-                    contents = xor_strings(contents, next_contents)
+        log('INIT: ' + path)
+        validateRootDirs(self.backends)
+        self.backends[0].traverse(on_file, on_dir, prefetch=4)
+        for filename in self.packed_files(dirs):
+            on_file(None, filename)
+
+    # xor the shares together a chunk at a time, so that memory use does
+    # not grow with the file
+    def rebuild_raid0(self, filename, chunksize=1 << 20):
+        record = self.manifest.get(filename)
+        sources = []
+        try:
+            if record and 'packed' in record:
+                pieces = self.packed_pieces(record)
+                throttles = [piece.backend.throttle for piece in pieces]
+                sizes = [throttle.call(piece_size, (piece,)) for throttle, piece in zip(throttles, pieces)]
+                for throttle, piece in zip(throttles, pieces):
+                    sources.append(throttle.call(open_piece, (piece,)))
+            else:
+                throttles = [backend.throttle for backend in self.backends]
+                sizes = [backend.throttle.call(backend.getsize, (filename,)) for backend in self.backends]
+                for backend in self.backends:
+                    sources.append(backend.throttle.call(backend.open, (filename, 'rb')))
+
+            for backend, size in zip(self.backends[1:], sizes[1:]):
+                if size != sizes[0]:
+                    error('Corrupt data: len(%s) != len (%s) (%d != %d)'
+                            % (self.backends[0].path(filename),
+                                backend.path(filename),
+                                sizes[0],
+                                size))
 
             full_path = self._full_path(filename)
-            with open(full_path, 'w') as dest:
-                dest.write(contents)
-
-            log('Wrote ' + full_path)
+            try:
+                with open(full_path + '.fetch', 'wb') as dest, self.memory.hold(chunksize * (len(sources) + 1)):
+                    while True:
+                        chunks = [throttle.call(source.read, (chunksize,))
+                                  for throttle, source in zip(throttles, sources)]
+                        if len(chunks[0]) == 0:
+                            break
+                        dest.write(xor_bytes(*chunks))
+            except:
+                os.remove(full_path + '.fetch')
+                raise
+        finally:
+            for source in sources:
+                source.close()
+
+        self._replace(full_path + '.fetch', full_path)
+        log('Wrote ' + full_path)
+        return True
 
-        def on_dir(dirname):
-            full_path = self._full_path(dirname)
+    def init_raid4(self, path):
+        log('INIT: ' + path)
+        for filename, pieces in self.find_pieces(self._make_dir).items():
+            self._restore(filename, self.manifest.get(filename), pieces)
+
+    # Rebuild filename in the temp dir from its pieces ({numer: piece},
+    # parity is 0). The pieces are streamed a chunk at a time into the
+    # encrypted file, each data piece at its place in it, rebuilding at
+    # most one missing data piece from the parity as they go.
+    def rebuild_raid4(self, filename, pieces, chunksize=1 << 20):
+        record = self.manifest.get(filename)
+        chunks = record and record.get('chunks')
+        denom = pieces.values()[0].denom
+        missing = [i for i in range(1, denom+1) if i not in pieces]
+        if len(missing) > 1 or (missing and 0 not in pieces):
+            log('not enough pieces to recover ' + filename)
+            return
+
+        full_path = self._full_path(filename)
+        def copy(chosen, read, size):
+            lengths = dict((n, size(n)) for n in chosen)
+            lost = [i for i in range(1, denom+1) if i not in chosen]
+            for i in lost:
+                log("didn't read piece %d of %s: reconstructing it now" % (i, filename))
+                if chunks:
+                    lengths[i] = chunks[i-1]
+                else:
+                    lengths[i] = lengths[0] - (pieces[0].extra_bytes if i == denom else 0)
+            starts = {1: 0}
+            for i in range(2, denom+1):
+                starts[i] = starts[i-1] + lengths[i-1]
+
+            with open(full_path + '.enc', 'wb') as dest:
+                for at in range(0, max(lengths.values()), chunksize):
+                    got = dict((n, read(n, chunksize)) for n in chosen)
+                    for i in lost:
+                        # Every piece is xored as if padded with 0s to the parity's length
+                        longest = max(len(data) for data in got.values())
+                        rebuilt = xor_bytes(*[data + '\0' * (longest - len(data)) for data in got.values()])
+                        got[i] = rebuilt[:max(0, min(chunksize, lengths[i] - at))]
+                    for i in range(1, denom+1):
+                        if got[i]:
+                            dest.seek(starts[i] + at)
+                            dest.write(got[i])
+
+        log('reconstructing %s from pieces' % full_path)
+        with self.memory.hold(2 * (denom + 1) * chunksize):
+            streamed = self.stream_pieces(filename, pieces, denom, copy)
+        if not streamed:
+            if os.path.exists(full_path + '.enc'):
+                os.remove(full_path + '.enc')
+            return
+        self._decrypt_enc(full_path)
+        return True
+
+    # Stream `needed` of pieces ({numer: piece}) into the temp dir with
+    # copy(chosen, read, size), where read(numer, length) reads the next
+    # chunk of a piece and size(numer) is its length. The pieces on the
+    # fastest roots are used; if one of them fails, a spare takes its
+    # place and the copy starts over. Every request goes through its
+    # root's throttle. Returns whether it got through.
+    def stream_pieces(self, filename, pieces, needed, copy):
+        failed = set()
+        while True:
+            chosen = sorted((n for n in pieces if pieces[n].backend not in failed),
+                            key=lambda n: self.scheduler.expected(pieces[n].backend))[:needed]
+            if len(chosen) < needed:
+                log('could not read enough pieces to recover ' + filename)
+                return False
+
+            sources = {}
+            def call(n, f, *args):
+                try:
+                    return pieces[n].backend.throttle.call(f, args)
+                except (IOError, OSError) as e:
+                    log('reading %s from %s failed: %s' % (pieces[n].path(), pieces[n].backend, e))
+                    failed.add(pieces[n].backend)
+                    raise
+
+            before = len(failed)
+            try:
+                for n in chosen:
+                    sources[n] = call(n, open_piece, pieces[n])
+                copy(sorted(chosen), lambda n, length: call(n, sources[n].read, length),
+                     lambda n: call(n, piece_size, pieces[n]))
+                return True
+            except (IOError, OSError):
+                if len(failed) == before:
+                    # Not the roots' fault
+                    raise
+            finally:
+                for source in sources.values():
+                    source.close()
+
+    # Decrypt the .enc file the pieces of full_path were put back
+    # together in, cutting off the padding the pieces were stored with,
+    # and put the result in its place.
+    def _decrypt_enc(self, full_path):
+        with open(full_path + '.enc', 'r+b') as enc:
+            enc.truncate(encrypted_size(enc.read(struct.calcsize('Q'))))
+        decrypt_file(self.key, full_path + '.enc', full_path + '.fetch')
+        os.remove(full_path + '.enc')
+        self._replace(full_path + '.fetch', full_path)
+
+    # Move temp, a new copy of full_path (fetched back, or a placeholder
+    # for it), into its place with the mode and times of the file it
+    # replaces. Until then that keeps its size, so getattr never sees a
+    # file being fetched or evicted shrink and grow again.
+    def _replace(self, temp, full_path):
+        if os.path.exists(full_path):
+            shutil.copystat(full_path, temp)
+        os.rename(temp, full_path)
+
+    # Read back what write_stripes wrote, reconstructing at most one
+    # missing data piece. chunks are the stripe sizes if they were
+    # weighted. Returns None if there are not enough pieces.
+    def read_stripes(self, filename, pieces, chunks=None):
+        denom = pieces.values()[0].denom
+        missing = [i for i in range(1, denom+1) if i not in pieces]
+        if len(missing) > 1 or (missing and 0 not in pieces):
+            log('not enough pieces to recover ' + filename)
+            return
+
+        # Any denom of the denom+1 pieces will do
+        contents = self.scheduler.fetch(pieces, denom)
+        missing = [i for i in range(1, denom+1) if i not in contents]
+        if len(missing) > 1 or (missing and 0 not in contents):
+            log('could not read enough pieces to recover ' + filename)
+            return
+
+        if missing:
+            i = missing[0]
+            log("didn't find piece %d of %s: reconstructing it now" % (i, filename))
+
+            # Every piece is xored as if padded with 0s to the parity's length
+            size = len(contents[0])
+            rebuilt = xor_bytes(*[c + '\0' * (size - len(c)) for c in contents.values()])
+
+            if chunks:
+                rebuilt = rebuilt[:chunks[i-1]]
+            elif i == denom and pieces[0].extra_bytes:
+                rebuilt = rebuilt[:-pieces[0].extra_bytes]
+            contents[i] = rebuilt
+
+        return ''.join(contents[i] for i in range(1, denom+1))
+
+    def _make_dir(self, dirname):
+        full_path = self._full_path(dirname)
+        if not os.path.isdir(full_path):
             os.mkdir(full_path)
             log('Created ' + full_path)
 
+    # Find every stored piece on every backend, grouped by logical file
+    # and block (None for files stored whole):
+    # { 'dir/foo': { None: { 0: piece, 3: piece, ... } } }. Each piece
+    # knows the backend it was found on. Files packed into segments are
+    # listed with no pieces; rebuild() finds theirs in the manifest.
+    def find_pieces(self, on_dir):
+        found = {}
+        dirs = set([''])
+        # List all the roots at once
+        listings = self.io.each(self.backends, lambda backend: list(backend.walk(prefetch=4)))
+        for backend, listing in zip(self.backends, listings):
+            for relpath, entry, st in listing:
+                if entry.is_dir():
+                    on_dir(relpath)
+                    dirs.add(relpath)
+                    continue
+                piece = fileToFilePiece(relpath)
+                piece.backend = backend
+                found.setdefault(piece.basename, {}).setdefault(piece.block, {})[piece.numer] = piece
+        for filename in self.packed_files(dirs):
+            found.setdefault(filename, {})
+        return found
+
+    # The files of dirpaths that are packed into segments
+    def packed_files(self, dirpaths):
+        found = []
+        for dirpath in dirpaths:
+            for name, record in self.manifest.records(dirpath).items():
+                if 'packed' in record:
+                    found.append(dirpath + '/' + name if dirpath else name)
+        return found
+
+    def init_ec(self, path):
         log('INIT: ' + path)
-        validateRootDirs(self.roots)
-        traverse(ufspath(self.roots[0]), on_file, on_dir)
-
-    def init_raid4(self, path):
-        def on_file(root, filename):
-            log('found ' + filename)
-
-            if os.path.isfile(self._full_path('.'.join(filename.split('.')[:-2]))):
-                log('file ' + str(filename.split('.')[:-2][0]) + ' already constructed. skipping...')
-                return
-
-            file_piece = fileToFilePiece(root + '/' + filename)
-            if file_piece.typ == 'raw':
-                other_file_pieces = { file_piece.numer: file_piece }
-            else:
-                other_file_pieces = { 'xor': file_piece }
-
-            for other_root in self.roots[0:]:
-                if(ufspath(other_root) == root):
+        for filename, pieces in self.find_pieces(self._make_dir).items():
+            self._restore(filename, self.manifest.get(filename), pieces)
+
+    # Like rebuild_raid4: any k shards are decoded a chunk at a time into
+    # the encrypted file.
+    def rebuild_ec(self, filename, pieces, chunksize=1 << 20):
+        k = self.rs.k
+        if len(pieces) < k:
+            log('not enough pieces to recover %s (%d of %d)' % (filename, len(pieces), k))
+            return
+
+        full_path = self._full_path(filename)
+        def copy(chosen, read, size):
+            shard_size = size(chosen[0])
+            if chosen != range(k):
+                log('reconstructing %s from parity' % filename)
+            with open(full_path + '.enc', 'wb') as dest:
+                for at in range(0, shard_size, chunksize):
+                    data = self.rs.decode(dict((n, read(n, chunksize)) for n in chosen))
+                    for j, chunk in enumerate(data):
+                        dest.seek(j * shard_size + at)
+                        dest.write(chunk)
+
+        log('reconstructing %s from pieces' % full_path)
+        with self.memory.hold(2 * k * chunksize):
+            streamed = self.stream_pieces(filename, pieces, k, copy)
+        if not streamed:
+            if os.path.exists(full_path + '.enc'):
+                os.remove(full_path + '.enc')
+            return
+        self._decrypt_enc(full_path)
+        return True
+
+    # Read back what write_shards wrote, decoding from parity as needed.
+    # Returns None if there are not enough pieces.
+    def read_shards(self, filename, pieces):
+        if len(pieces) < self.rs.k:
+            log('not enough pieces to recover %s (%d of %d)' % (filename, len(pieces), self.rs.k))
+            return
+
+        available = self.scheduler.fetch(pieces, self.rs.k)
+        if len(available) < self.rs.k:
+            log('could not read enough pieces to recover ' + filename)
+            return
+        if not all(i in available for i in range(self.rs.k)):
+            log('reconstructing %s from parity' % filename)
+        contents = ''.join(self.rs.decode(available))
+        return contents[:encrypted_size(contents)]
+
+    # Rebuild the given blocks (all of them by default) of a file stored
+    # in blocks, from pieces ({block: {numer: piece}}), writing each in
+    # place in the temp dir. Returns whether they could all be read.
+    #
+    # A local copy that is already there keeps its size: it may have
+    # been appended to or truncated since the file was stored, so only
+    # what of each block lies within it is written.
+    def rebuild_blocks(self, filename, pieces, wanted=None):
+        record = self.manifest.get(filename)
+        if wanted is None:
+            wanted = range(len(record['blocks']))
+
+        full_path = self._full_path(filename)
+        if not os.path.exists(full_path):
+            with open(full_path, 'wb') as dest:
+                dest.truncate(record['size'])
+        end = os.path.getsize(full_path)
+        wanted = [block for block in wanted if block * record['block_size'] < end]
+        complete = True
+        with open(full_path, 'r+b') as dest:
+            def write(block, data):
+                offset = block * record['block_size']
+                pwrite(dest.fileno(), data[:end - offset], offset)
+            if 'row' in record:
+                return self.rebuild_rows(write, filename, pieces, record, wanted)
+            for block in wanted:
+                name = '%s block %d' % (filename, block)
+                if block not in pieces:
+                    log('no pieces of %s on any root' % name)
+                    complete = False
                     continue
-                temp = filename.split('.')
-                for i in range(1, file_piece.denom+1):
-                    if i in other_file_pieces:
+                with self.memory.hold(self._coding_cost(record['block_size'])):
+                    if self.raid == 'ec':
+                        contents = self.read_shards(name, pieces[block])
+                    else:
+                        contents = self.read_stripes(name, pieces[block], record['blocks'][block])
+                    if contents is None:
+                        complete = False
                         continue
+                    write(block, decrypt_block(self.key, contents))
+        return complete
+
+    def rebuild_rows(self, write, filename, pieces, record, wanted):
+        per_row = record['row']
+        count = len(record['blocks'])
+        rows = {}
+        for block in wanted:
+            rows.setdefault(block / per_row, []).append(block)
+
+        complete = True
+        for row, blocks in sorted(rows.items()):
+            first = row * per_row
+            members = [0] + range(1, min(per_row, count - first) + 1)
+            with self.memory.hold(self._coding_cost(per_row * record['block_size'])):
+                got = self.read_row('%s row %d' % (filename, row),
+                                    self.row_pieces(pieces, row, per_row, count),
+                                    members, [block - first + 1 for block in blocks])
+                if got is None:
+                    complete = False
+                    continue
+                for block in blocks:
+                    write(block, decrypt_block(self.key, got[block - first + 1]))
+        return complete
+
+    # Rebuild one file from the roots into the temp dir, from pieces
+    # grouped as file_pieces() does (looked up if not given). Returns
+    # whether it could be read.
+    def rebuild(self, filename, pieces=None):
+        if self.raid == 0:
+            return self.rebuild_raid0(filename)
+
+        record = self.manifest.get(filename)
+        if record and 'packed' in record:
+            pieces = {None: dict((piece.numer, piece) for piece in self.packed_pieces(record))}
+        elif pieces is None:
+            pieces = self.file_pieces(filename)
+        if record and 'blocks' in record:
+            return self.rebuild_blocks(filename, pieces)
+        if None not in pieces:
+            log('no pieces of %s on any root' % filename)
+        elif self.raid in (4, 5):
+            return self.rebuild_raid4(filename, pieces[None])
+        elif self.raid == 'ec':
+            return self.rebuild_ec(filename, pieces[None])
+        else:
+            error('NOT REACHED')
 
-                    temp[-2] = str(i)
-                    new_filename = '.'.join(temp)
-                    if os.path.isfile(ufspath(other_root, new_filename)):
-                        log('found %s in %s' % (new_filename, other_root))
-                        new_file_piece = fileToFilePiece(ufspath(other_root, new_filename))
-                        other_file_pieces[new_file_piece.numer] = new_file_piece
-                        break
-                else:
-                    for i in range(0,file_piece.denom):
-                        temp[-2] = 'xor%d' % i
-                        new_filename = '.'.join(temp)
-                        if os.path.isfile(ufspath(other_root, new_filename)):
-                            log('found %s in %s' % (new_filename, other_root))
-                            other_file_pieces['xor'] = fileToFilePiece(ufspath(other_root, new_filename))
-                            break
-                    #else:
-                        #log('no piece found for ' + filename)
-                        #return
-
-            if len(other_file_pieces) < file_piece.denom-1:
-                log('not enough pieces to recover ' + filename)
+    ############################################################################
+    # Segment compaction
+
+    def _compact_loop(self):
+        while not self.stopping:
+            try:
+                self.compact()
+            except (IOError, OSError) as e:
+                log('compacting segments failed: %s' % e)
+            self.compact_wakeup.wait(COMPACT_INTERVAL)
+            self.compact_wakeup.clear()
+
+    # Copy the live pieces of mostly-garbage segments into a new segment
+    # and drop the old ones. Nothing new is ever packed into an old
+    # segment, and files renamed in the meantime are matched by where
+    # their pieces are rather than by name.
+    def compact(self):
+        for sid in self.segments.garbage(COMPACT_THRESHOLD):
+            if self.stopping:
                 return
+            with self.lock:
+                live = [self.manifest.get(filename) for filename in self.segments.files(sid)]
+            live = [record['packed'] for record in live
+                    if record and record.get('packed', {}).get('segment') == sid]
+
+            log('compacting segment %s (%d live files)' % (sid, len(live)))
+            self._changing()
+            new = SegmentWriter(self.backends, self.io, self.memory)
+            if live:
+                with self.memory.hold(self.segments.size(sid)):
+                    segments = self.io.each(self.backends, lambda backend: backend.read_meta(segment_name(sid)))
+                    if None in segments:
+                        log('segment %s is missing from a root, not compacting it' % sid)
+                        continue
+                    for n, location in enumerate(live):
+                        for backend, data, (name, offset, length) in zip(self.backends, segments, location['pieces']):
+                            new.add(n, backend, name, data[offset:offset+length])
+                    del segments
+                moved = new.write()
+
+            with self.lock:
+                files = {}
+                for filename in self.segments.files(sid):
+                    record = self.manifest.get(filename)
+                    if not record or 'packed' not in record or record['packed'] not in live:
+                        continue
+                    n = live.index(record['packed'])
+                    self.manifest.set(filename, dict(record, packed=moved[n]))
+                    files[filename] = new.size_of(n)
+                    self.segments.release(sid, filename)
+                if files:
+                    self.segments.add(new.sid, sum(new.sizes), files)
+                self.segments.drop(sid)
+                self.manifest.save()
+                self.segments.save()
+
+            self.io.each(self.backends, lambda backend: backend.remove_meta(segment_name(sid)))
 
-            for i in range(1,file_piece.denom+1):
-                if i not in other_file_pieces:
-                    log("didn't find piece %d of %s: reconstructing it now" % (i, file_piece.basename))
-
-                    extra_bytes = other_file_pieces['xor'].extra_bytes
-
-                    pieces_contents = []
-                    for piece in other_file_pieces.values():
-                        if piece.typ == 'raw' and piece.numer == file_piece.denom:
-                            log('appending %d bytes to piece %d before xor' % (extra_bytes, piece.denom))
-                            pieces_contents.append(
-                                    open(piece.path(), 'r').read()
-                                    + '\0'*extra_bytes)
-                        else:
-                            pieces_contents.append(open(piece.path(), 'r').read())
-
-                    piece_i_contents = xor_strings(*pieces_contents)
-                    if i == file_piece.denom:
-                        piece_i_contents = piece_i_contents[:-extra_bytes]
-
-                    log('writing piece %d to /tmp/foo.1.1' % i)
-                    with open('/tmp/foo.1.1', 'w') as temp_handle:
-                        temp_handle.write(xor_strings(*pieces_contents))
-
-                    other_file_pieces[i] = RawFilePiece('/tmp/foo', 1, 1)
-
-            full_path = self._full_path('.'.join(filename.split('.')[:-2]))
-            log('reconstructing %s from pieces' % full_path)
-            with open(full_path + ".enc", 'w') as dest:
-                for i in range(1, file_piece.denom+1):
-                    log('reconstructing using piece %d: %s' % (i, other_file_pieces[i].path()))
-                    dest.write(open(other_file_pieces[i].path(), 'r').read())
-            decrypt_file(self.key, full_path+".enc")
-            os.remove(full_path+".enc")
-
-        def on_dir(dirname):
-            full_path = self._full_path(dirname)
-            os.mkdir(full_path)
-            log('Created ' + full_path)
-
-        log('INIT: ' + path)
-        for other_root in self.roots[0:]:
-            traverse(ufspath(other_root), on_file, on_dir)
+    ############################################################################
+    # Local cache
+
+    # Put filename back in the temp dir at mount time. If its manifest
+    # record says how big it is, that is only a placeholder for now, left
+    # for the hydrator to fetch; files stored before records had sizes
+    # are rebuilt right away.
+    def _restore(self, filename, record, pieces=None):
+        full_path = self._full_path(filename)
+        if record and 'size' in record:
+            self._placeholder(filename, record['size'], record.get('mtime'))
+            return
+
+        self.rebuild(filename, pieces)
+        if os.path.isfile(full_path):
+            self.cache.touch('/' + filename, os.path.getsize(full_path))
+            self._evict()
+
+    # Leave a placeholder of size bytes in filename's place, for the
+    # hydrator to fetch
+    def _placeholder(self, filename, size, mtime=None):
+        full_path = self._full_path(filename)
+        with open(full_path, 'wb') as placeholder:
+            placeholder.truncate(size)
+        if mtime is not None:
+            os.utime(full_path, (mtime, mtime))
+        self.cache.evict('/' + filename)
+        self.hydrator.add('/' + filename)
+
+    # Make sure the local copy of path is the real thing and not an
+    # evicted placeholder, fetching it back from the roots if need be.
+    # For files stored in blocks only the blocks covering length bytes
+    # at offset are fetched; length None means all of the file. Callers
+    # that go on to use the copy pin path around both, or it may be
+    # evicted again in between.
+    def _ensure(self, path, offset=0, length=None):
+        if not self.cache.is_evicted(path):
+            return
+        filename = path.lstrip('/')
+        with self._fetch_lock(path):
+            if not self.cache.is_evicted(path):
+                return
+            full_path = self._full_path(path)
+            st = os.stat(full_path)
+            record = self.manifest.get(filename)
+            if record and 'blocks' in record:
+                count = len(record['blocks'])
+                missing = self.cache.missing_blocks(path)
+                if missing is None:
+                    missing = set(range(count))
+                size = record['block_size']
+                if length is None:
+                    # What was fetched already may have been written to
+                    wanted = sorted(missing)
+                else:
+                    wanted = [block for block in range(offset / size, (offset + length + size - 1) / size)
+                              if block in missing]
+                if not wanted:
+                    return
+                log('FETCH %s blocks %s' % (path, wanted))
+                ok = self.rebuild_blocks(filename, self.file_pieces(filename), wanted)
+                resident = min((count - len(missing) + len(wanted)) * size, st.st_size)
+            else:
+                log('FETCH ' + path)
+                ok = self.rebuild(filename)
+                wanted = missing = ()
+                resident = st.st_size
+
+            if not ok or os.path.getsize(full_path) != st.st_size:
+                log('could not fetch %s back from the roots' % path)
+                raise FuseOSError(errno.EIO)
+            os.utime(full_path, (st.st_atime, st.st_mtime))
+            self.cache.fill(path, wanted, set(missing), resident)
+        self._evict()
+
+    # Evict least recently used clean files until the cache is back under
+    # its cap. An evicted file is replaced with a sparse file of the same
+    # size and times, so getattr and readdir never need the roots, and
+    # never see it shrink.
+    def _evict(self):
+        def is_clean(path):
+            return path not in self.dirty and not any(
+                path == new or path.startswith(new + '/') for new in self.renamed)
+        with self.lock:
+            victims = self.cache.victims(is_clean)
+        for path in victims:
+            with self._fetch_lock(path):
+                with self.lock:
+                    # Written, renamed or removed since it was picked
+                    if not is_clean(path):
+                        continue
+                    full_path = self._full_path(path)
+                    if self.cache.is_evicted(path) or not os.path.isfile(full_path):
+                        continue
+                    st = os.stat(full_path)
+                    if st.st_nlink > 1:
+                        # Hard links share the data with a dirty name
+                        continue
+                    # Marked before the file is touched, unless it was
+                    # opened since it was picked: whatever opens it from
+                    # here on fetches it back, once this is done
+                    if not self.cache.evict_unpinned(path):
+                        continue
+                    log('EVICT ' + path)
+                    with open(full_path + '.evict', 'wb') as placeholder:
+                        placeholder.truncate(st.st_size)
+                    self._replace(full_path + '.evict', full_path)
 
     def link(self, target, name):
-        log('LINK ' + path)
-        return os.link(self._full_path(target), self._full_path(name))
+        log('LINK %s -> %s' % (name, target))
+        with self.cache.pinned(target):
+            self._ensure(target)
+            with self.lock:
+                self._journal('link', name, target)
+                return os.link(self._full_path(target), self._full_path(name))
 
     def mkdir(self, path, mode):
         log('MKDIR ' + path)
-        return os.mkdir(path, mode)
+        with self.lock:
+            self._journal('mkdir', path)
+            return os.mkdir(self._full_path(path), mode)
 
     def mknod(self, path, mode, dev):
         log('MKNOD ' + path)
-        return os.mknod(self._full_path(path), mode, dev)
+        with self.lock:
+            self._journal('mknod', path)
+            return os.mknod(self._full_path(path), mode, dev)
 
     def open(self, path, flags):
         log('OPEN ' + path)
         full_path = self._full_path(path)
-        return os.open(full_path, flags)
+        # Files stored in blocks are fetched as they are read, and in
+        # the background
+        self.hydrator.bump(path)
+        self.cache.pin(path)
+        try:
+            self._ensure(path, 0, 0)
+            fh = os.open(full_path, flags)
+        except:
+            self.cache.unpin(path)
+            raise
+        self.cache.touch(path, os.fstat(fh).st_size)
+        return fh
 
     def read(self, path, length, offset, fh):
         log('READ ' + path)
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.read(fh, length)
+        self._ensure(path, offset, length)
+        self._flush_writes(path)
+        return pread(fh, length, offset)
 
     def readdir(self, path, fh):
         log('READDIR ' + path)
@@ -417,6 +1678,8 @@ class UnifiedCloudStorage(Operations):
         dirents = ['.', '..']
         if os.path.isdir(full_path):
             dirents.extend(os.listdir(full_path))
+            for name in dirents[2:]:
+                self.hydrator.bump(os.path.join(path, name))
         for r in dirents:
             yield r
 
@@ -431,11 +1694,57 @@ class UnifiedCloudStorage(Operations):
 
     def release(self, path, fh):
         log('RELEASE ' + path)
-        return os.close(fh)
+        try:
+            with self._inode_lock(fh=fh):
+                buf = self.write_buffers.get(fh)
+                if buf is not None:
+                    buf.flush()
+            self.cache.touch(path, os.fstat(fh).st_size)
+        finally:
+            with self.lock:
+                buf = self.write_buffers.pop(fh, None)
+            if buf is not None:
+                buf.drop()
+            self.cache.unpin(path)
+            os.close(fh)
+        self._evict()
 
     def rename(self, old, new):
-        log('RENAME ' + path)
-        return os.rename(self._full_path(old), self._full_path(new))
+        log('RENAME %s -> %s' % (old, new))
+        # The roots only learn about the new name at the next flush, so
+        # anything not fetched yet has to be fetched under the old one,
+        # and stays resident until then
+        fetched = self.cache.evicted_under(old)
+        for path in fetched:
+            self.cache.pin(path)
+        try:
+            for path in fetched:
+                self._ensure(path)
+            with self.lock:
+                self._journal('rename', old, new)
+                self.dirty = set(new + p[len(old):] if p == old or p.startswith(old + '/') else p
+                                 for p in self.dirty)
+                self.renamed = set(new + p[len(old):] if p == old or p.startswith(old + '/') else p
+                                   for p in self.renamed)
+                self.renamed.add(new)
+                for p in list(self.dirty_blocks):
+                    if p == old or p.startswith(old + '/'):
+                        self.dirty_blocks[new + p[len(old):]] = self.dirty_blocks.pop(p)
+                self.cache.rename(old, new)
+                fetched = [new + path[len(old):] for path in fetched]
+                for buf in self.write_buffers.values():
+                    if buf.path == old or buf.path.startswith(old + '/'):
+                        buf.path = new + buf.path[len(old):]
+                return os.rename(self._full_path(old), self._full_path(new))
+        finally:
+            for path in fetched:
+                self.cache.unpin(path)
+
+    def rmdir(self, path):
+        log('RMDIR ' + path)
+        with self.lock:
+            self._journal('rmdir', path)
+            return os.rmdir(self._full_path(path))
 
     def statfs(self, path):
         log('STATFS ' + path)
@@ -455,18 +1764,39 @@ class UnifiedCloudStorage(Operations):
             ))
 
     def symlink(self, target, name):
-        log('SYMLINK ' + path)
-        return os.symlink(self._full_path(target), self._full_path(name))
+        log('SYMLINK %s -> %s' % (name, target))
+        with self.lock:
+            self._journal('symlink', name, target)
+            return os.symlink(self._full_path(target), self._full_path(name))
 
     def truncate(self, path, length, fh=None):
         log('TRUNCATE ' + path)
+        self._flush_writes(path)
         full_path = self._full_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        size = os.path.getsize(full_path)
+        with self.cache.pinned(path):
+            # The block the file now ends in keeps some of its old data
+            self._ensure(path, min(size, length), 1)
+            with self._inode_lock(path):
+                with open(full_path, 'r+') as f:
+                    f.truncate(length)
+                record = self.manifest.get(path.lstrip('/'))
+                if record and 'blocks' in record:
+                    self.cache.cut(path, (length + record['block_size'] - 1) / record['block_size'],
+                                   len(record['blocks']))
+                with self.lock:
+                    self._journal('truncate', path, str(length))
+                    self.dirty.add(path)
+                    self._dirty_range(path, min(size, length), max(size, length))
 
     def unlink(self, path):
         log('UNLINK ' + path)
-        return os.unlink(self._full_path(path))
+        with self.lock:
+            self._journal('unlink', path)
+            self.dirty.discard(path)
+            self.dirty_blocks.pop(path, None)
+            self.cache.forget(path)
+            return os.unlink(self._full_path(path))
 
     def utimens(self, path, times=None):
         log('UTIMENS ' + path)
@@ -474,21 +1804,52 @@ class UnifiedCloudStorage(Operations):
 
     def write(self, path, buf, offset, fh):
         log('WRITE ' + path)
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
-
-def error(*args):
-    print("ERROR: ", *args, file=sys.stderr)
-    exit(1)
-
-def log(*args):
-    print(*args, file=sys.stderr)
+        self._ensure(path, offset, len(buf))
+        with self._inode_lock(fh=fh):
+            if not self.write_buffer:
+                written = pwrite(fh, buf, offset)
+                self._written(path, offset, offset + written)
+                return written
+            buffered = self.write_buffers.get(fh)
+            if buffered is None:
+                buffered = WriteBuffer(fh, path, self.block_size, self.write_buffer, self._written,
+                                       self.memory)
+                with self.lock:
+                    self.write_buffers[fh] = buffered
+            buffered.add(offset, buf)
+            return len(buf)
 
 if __name__ == '__main__':
+    args = []
+    options = {}
+    for arg in sys.argv[1:]:
+        if arg.startswith('--cache-dir='):
+            options['cache_dir'] = arg.split('=', 1)[1]
+        elif arg.startswith('--cache-size='):
+            options['cache_size'] = parse_size(arg.split('=', 1)[1])
+        elif arg.startswith('--block-size='):
+            options['block_size'] = parse_size(arg.split('=', 1)[1])
+        elif arg.startswith('--pack-size='):
+            options['pack_size'] = parse_size(arg.split('=', 1)[1])
+        elif arg.startswith('--write-buffer='):
+            options['write_buffer'] = parse_size(arg.split('=', 1)[1])
+        elif arg.startswith('--io-per-root='):
+            options['io_per_root'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--memory-limit='):
+            options['memory_limit'] = parse_size(arg.split('=', 1)[1]) or None
+        elif arg.startswith('--meta-cache='):
+            options['meta_cache'] = arg.split('=', 1)[1] or None
+        else:
+            args.append(arg)
+    sys.argv[1:] = args
+
     if len(sys.argv) < 5:
-        error('Usage: %s [--raid0|--raid4] <mountpoint> [if raid4 then KEYPHRASE] [<sub-filesystems>]' % sys.argv[0])
+        error('Usage: %s [--raid0|--raid4|--raid5|--ec=K+M] [--cache-dir=DIR] [--cache-size=SIZE] [--block-size=SIZE] [--pack-size=SIZE] [--write-buffer=SIZE] [--io-per-root=N] [--memory-limit=SIZE] [--meta-cache=DIR] <mountpoint> [if raid4/5/ec then KEYPHRASE] [<sub-filesystems>]\n'
+              '(a sub-filesystem may be followed by ?weight=..&ops=..&rate=.. to weight its share and cap its requests and bytes per second,\n'
+              ' and may be sim:<dir>?latency=..&jitter=..&bandwidth=..&failures=..&quota=.. to simulate a cloud drive)' % sys.argv[0])
 
     FUSE(
-        UnifiedCloudStorage(sys.argv[1], sys.argv[3:]),
+        UnifiedCloudStorage(sys.argv[1], sys.argv[3:], **options),
         sys.argv[2],
-        foreground=True)
+        foreground=True,
+        nothreads=False)
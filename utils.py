@@ -1,4 +1,32 @@
+from __future__ import print_function
+
+import binascii
+import cStringIO
+import hashlib
 import os
+import Queue
+import re
+import sys
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def error(*args):
+    print("ERROR: ", *args, file=sys.stderr)
+    exit(1)
+
+def log(*args):
+    print(*args, file=sys.stderr)
+
+# ufspath('foo') = 'foo/.ufs'
+# ufspath('foo', 'bar/baz' = 'foo/.ufs/bar/baz'
+def ufspath(root, path=None):
+    if path is None:
+        return root + '/.ufs'
+    return root + '/.ufs/' + path
 
 # xor_strings("foo", "bar", "baz") = "foo" xor "bar" xor "baz"
 def xor_strings(str1, *strs):
@@ -6,19 +34,195 @@ def xor_strings(str1, *strs):
         str1 = "".join(chr(ord(x) ^ ord(y)) for x,y in zip(str1,s))
     return str1
 
+# A fixed pool of locks shared out by hashing the key, so per-inode
+# locking costs a constant amount of memory no matter how many inodes
+# are touched.
+#
+# ex:
+#
+# stripes = LockStripes()
+# with stripes(inode):
+#     ...
+class LockStripes(object):
+    def __init__(self, count=64):
+        self.locks = [threading.RLock() for i in range(count)]
+
+    def __call__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+# Serializes lseek+read/write on the same fd where the os module has no
+# positional I/O (python2).
+_fd_locks = LockStripes()
+
+# pread(fd, n, offset) = os.read of n bytes at offset, without touching
+# (or racing on) the fd's file position
+def pread(fd, length, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, length, offset)
+    with _fd_locks(fd):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+def pwrite(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    with _fd_locks(fd):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+# xor_bytes("foo", "bar") = "foo" xor "bar", like xor_strings but for
+# strings of equal length and done with numpy (or failing that on big
+# integers), which is orders of magnitude faster than going character
+# by character.
+def xor_bytes(first, *rest):
+    if not first:
+        return first
+    if numpy is not None:
+        acc = numpy.frombuffer(first, dtype=numpy.uint8).copy()
+        for s in rest:
+            acc ^= numpy.frombuffer(s, dtype=numpy.uint8)
+        return acc.tostring()
+    acc = int(binascii.hexlify(first), 16)
+    for s in rest:
+        acc ^= int(binascii.hexlify(s), 16)
+    return binascii.unhexlify('%0*x' % (2 * len(first), acc))
+
 def directory_dict(path):
     ret = {}
-    for child in os.listdir(path):
-        fullpath = path + '/' + child
-        if os.path.isfile(fullpath):
-            ret[child] = {}
-        elif os.path.isdir(fullpath):
-            ret[child] = directory_dict(fullpath)
+    for relpath, entry, st in walk(path):
+        node = ret
+        for part in relpath.split('/'):
+            node = node.setdefault(part, {})
     return ret
 
+# os.scandir where we have it (python3, or the scandir backport on
+# python2), otherwise listdir plus lazy stats behind the same interface.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+class ListdirEntry(object):
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = dirpath + '/' + name
+        self._stat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=True):
+        return os.path.isdir(self.path)
+
+    def is_file(self, follow_symlinks=True):
+        return os.path.isfile(self.path)
+
+def scan_dir(path):
+    if scandir is not None:
+        return list(scandir(path))
+    return [ListdirEntry(path, name) for name in os.listdir(path)]
+
+# Lists directories on background threads, so that the listings of
+# subdirectories are already on their way while the caller is still
+# busy with their parent.
+class Prefetcher(object):
+    def __init__(self, list_dir, threads):
+        self.list_dir = list_dir
+        self.jobs = Queue.Queue()
+        self.results = {}
+        self.lock = threading.Condition()
+        self.threads = []
+        for i in range(threads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+
+    def _work(self):
+        while True:
+            path = self.jobs.get()
+            if path is None:
+                return
+            try:
+                result = (self.list_dir(path), None)
+            except Exception as e:
+                result = (None, e)
+            with self.lock:
+                self.results[path] = result
+                self.lock.notify_all()
+
+    def submit(self, path):
+        self.jobs.put(path)
+
+    def close(self):
+        for i in range(len(self.threads)):
+            self.jobs.put(None)
+        for worker in self.threads:
+            worker.join()
+
+    def get(self, path):
+        with self.lock:
+            while path not in self.results:
+                self.lock.wait()
+            entries, e = self.results.pop(path)
+        if e is not None:
+            raise e
+        return entries
+
+# Walk a directory hierarchy without recursion, yielding
+# (relpath, entry, stat) for every file and directory below top, with
+# paths RELATIVE to top. Directories come before their contents. The
+# entry is the DirEntry from the listing, so its type costs nothing
+# extra; stat is only fetched when with_stat is set. list_dir(path)
+# replaces scan_dir (e.g. for a backend), and prefetch > 0 lists that
+# many subdirectories concurrently ahead of the walk.
+#
+# ex:
+#
+# for relpath, entry, st in walk(root):
+#     print(relpath)
+def walk(top, prefetch=0, with_stat=False, list_dir=scan_dir):
+    prefetcher = Prefetcher(list_dir, prefetch) if prefetch else None
+    try:
+        for item in _walk(top, prefetcher, with_stat, list_dir):
+            yield item
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+def _walk(top, prefetcher, with_stat, list_dir):
+    stack = [None]
+    while stack:
+        relroot = stack.pop()
+        fullroot = top if relroot is None else top + '/' + relroot
+        if prefetcher is not None and relroot is not None:
+            entries = prefetcher.get(fullroot)
+        else:
+            entries = list_dir(fullroot)
+
+        subdirs = []
+        for entry in sorted(entries, key=lambda e: e.name):
+            relpath = entry.name if relroot is None else relroot + '/' + entry.name
+            is_dir = entry.is_dir()
+            if is_dir:
+                subdirs.append(relpath)
+                if prefetcher is not None:
+                    prefetcher.submit(top + '/' + relpath)
+            elif not entry.is_file():
+                continue
+            yield relpath, entry, entry.stat() if with_stat else None
+
+        stack.extend(reversed(subdirs))
+
 # Traverse a directory hierarchy, calling on_file on files
-# and on_dir on directories. The path passed to each function
-# is the path RELATIVE to the root (first argument).
+# and on_dir on directories. on_dir gets the path RELATIVE to
+# the root (first argument); on_file gets the root and the
+# relative path.
 #
 # ex:
 #
@@ -31,56 +235,110 @@ def directory_dict(path):
 #
 # prints:
 #
+# baz
 # foo
 # foo/bar
-# baz
 #
-# traverse :: FilePath -> (FilePath -> IO ()) -> (FilePath -> IO ()) -> IO ()
-def traverse(path, on_file, on_dir):
-    for child in os.listdir(path):
-        fullpath = path + '/' + child
-        if os.path.isfile(fullpath):
-            on_file(path, child)
-        elif os.path.isdir(fullpath):
-            on_dir(child)
-            traverse_(path, child, on_file, on_dir)
-
-def traverse_(root, relroot, on_file, on_dir):
-    fullroot = root + '/' + relroot
-    for child in os.listdir(fullroot):
-        fullpath = fullroot + '/' + child
-        relpath = relroot + '/' + child
-        if os.path.isfile(fullpath):
-            on_file(relpath)
-        elif os.path.isdir(fullpath):
+# traverse :: FilePath -> (FilePath -> FilePath -> IO ()) -> (FilePath -> IO ()) -> IO ()
+def traverse(path, on_file, on_dir, prefetch=0, list_dir=scan_dir):
+    for relpath, entry, st in walk(path, prefetch, list_dir=list_dir):
+        if entry.is_dir():
             on_dir(relpath)
-            traverse_(root, relpath, on_file, on_file, on_dir)
+        else:
+            on_file(path, relpath)
+
+# A stable number in [0, n) for relpath, the same on every machine and
+# every run (unlike hash()), used to rotate piece placement per file.
+def rotation(relpath, n):
+    return int(hashlib.md5(relpath).hexdigest()[:8], 16) % n
+
+# Files stored in fixed-size blocks have one set of pieces per block,
+# named like the pieces of a whole file with .b<block> appended:
+# foo.1.4.b7 is piece 1 of block 7 of foo.
+BLOCK_SUFFIX = re.compile(r'\.b(\d+)$')
+
+def block_suffix(block):
+    return '' if block is None else '.b%d' % block
+
+# Is name (a file in the same directory) one of the pieces of basename?
+def is_piece_name(name, basename):
+    if not name.startswith(basename + '.'):
+        return False
+    rest = name[len(basename):]
+    return rest.count('.') == 2 or (rest.count('.') == 3 and BLOCK_SUFFIX.search(rest) is not None)
 
 # foo.1.4
 class RawFilePiece:
-    def __init__(self, basename, numer, denom):
+    def __init__(self, basename, numer, denom, block=None):
         self.typ = 'raw'
         self.basename = basename
         self.numer = numer
         self.denom = denom
+        self.block = block
 
     def path(self):
-        return '%s.%d.%d' % (self.basename, self.numer, self.denom)
+        return '%s.%d.%d%s' % (self.basename, self.numer, self.denom, block_suffix(self.block))
 
 # foo.xor1.4
 class XorFilePiece:
-    def __init__(self, basename, extra_bytes, denom):
+    def __init__(self, basename, extra_bytes, denom, block=None):
         self.typ = 'xor'
+        self.numer = 0
         self.basename = basename
         self.extra_bytes = extra_bytes
         self.denom = denom
+        self.block = block
+
+    def path(self):
+        return '%s.xor%d.%d%s' % (self.basename, self.extra_bytes, self.denom, block_suffix(self.block))
+
+# foo.rs5.4+2: shard 5 of a 4+2 Reed-Solomon code. Shards 0..k-1 are
+# the data split in k, shards k..k+m-1 are parity.
+class RsFilePiece:
+    def __init__(self, basename, numer, k, m, block=None):
+        self.typ = 'rs'
+        self.basename = basename
+        self.numer = numer
+        self.k = k
+        self.m = m
+        self.denom = k + m
+        self.block = block
 
     def path(self):
-        return '%s.xor%d.%d' % (self.basename, self.extra_bytes, self.denom)
+        return '%s.rs%d.%d+%d%s' % (self.basename, self.numer, self.k, self.m, block_suffix(self.block))
+
+# Read a piece from the backend it was found on: its own file, or its
+# (name, offset, length) range of a metadata file if it was packed into
+# a segment (see segments.py).
+def read_piece(piece):
+    location = getattr(piece, 'location', None)
+    if location is None:
+        return piece.backend.read(piece.path())
+    return piece.backend.read_meta_range(*location)
+
+# Like read_piece, but a file object to read the piece from a chunk at a
+# time. Packed pieces are small and just read whole.
+def open_piece(piece):
+    location = getattr(piece, 'location', None)
+    if location is None:
+        return piece.backend.open(piece.path(), 'rb')
+    return cStringIO.StringIO(piece.backend.read_meta_range(*location))
+
+def piece_size(piece):
+    location = getattr(piece, 'location', None)
+    if location is None:
+        return piece.backend.getsize(piece.path())
+    return location[2]
 
 def fileToFilePiece(filename):
     dirname = os.path.dirname(filename)
     basename = os.path.basename(filename)
+
+    block = None
+    match = BLOCK_SUFFIX.search(basename)
+    if match:
+        block = int(match.group(1))
+        basename = basename[:match.start()]
     split_basename = basename.split('.')
 
     if len(split_basename) < 3:
@@ -92,10 +350,20 @@ def fileToFilePiece(filename):
     if split_basename[-2].startswith('xor'):
         return XorFilePiece(
                 orig_filename,
-                int(split_basename[-2][-1]),
-                int(split_basename[-1]))
+                int(split_basename[-2][3:]),
+                int(split_basename[-1]),
+                block)
+    elif split_basename[-2].startswith('rs'):
+        k, m = split_basename[-1].split('+')
+        return RsFilePiece(
+                orig_filename,
+                int(split_basename[-2][2:]),
+                int(k),
+                int(m),
+                block)
     else:
         return RawFilePiece(
                 orig_filename,
                 int(split_basename[-2]),
-                int(split_basename[-1]))
+                int(split_basename[-1]),
+                block)
@@ -0,0 +1,117 @@
+from utils import *
+from memory import WRITE_SHARE
+
+# FUSE hands writes over in small pieces (4 KiB by default), and doing a
+# pwrite for each one makes sequential writes cost a syscall per page.
+# Each open handle gets a WriteBuffer instead: writes are collected in
+# memory, adjacent and overlapping ones merged into extents, and written
+# to the handle in one go once they fill a whole block, once the buffer
+# grows past its cap, or when the handle is flushed or released.
+#
+# Anything that looks at the file by other means than this handle (reads,
+# stat, truncate) has to flush it first. written(path, start, end) is
+# called once bytes [start, end) have actually been written, so that the
+# file is only taken as changed once the change is there to upload.
+#
+# The buffered bytes are reserved from the memory budget. When there is
+# no room left for write buffers, writes go straight through.
+class WriteBuffer(object):
+    def __init__(self, fh, path, block_size, capacity, written, memory):
+        self.fh = fh
+        self.path = path
+        self.written = written
+        self.memory = memory
+        self.ino = os.fstat(fh).st_ino
+        self.block_size = block_size
+        self.capacity = capacity
+        # [offset, bytearray], sorted, neither overlapping nor touching
+        self.extents = []
+        self.size = 0
+        self.reserved = 0
+
+    def add(self, offset, data):
+        if not self.memory.try_reserve(len(data), WRITE_SHARE):
+            self.flush()
+            self._write(offset, data)
+            return
+        self.reserved += len(data)
+        self._add(offset, data)
+        self._settle()
+
+    # Give back what the buffer no longer holds
+    def _settle(self):
+        self.memory.release(self.reserved - self.size)
+        self.reserved = self.size
+
+    def _add(self, offset, data):
+        end = offset + len(data)
+        if self.extents and self.extents[-1][0] + len(self.extents[-1][1]) == offset:
+            # Sequential writes just grow the last extent
+            extent = self.extents[-1]
+            extent[1].extend(data)
+            self.size += len(data)
+        else:
+            extent = self._merge(offset, end, data)
+
+        if self.size > self.capacity:
+            self.flush()
+            return
+        # Once the extent covers a whole block, write out everything up to
+        # its last block boundary
+        start = extent[0]
+        first = (start + self.block_size - 1) / self.block_size * self.block_size
+        last = (start + len(extent[1])) / self.block_size * self.block_size
+        if last - first >= self.block_size:
+            self._write(start, extent[1][:last - start])
+            del extent[1][:last - start]
+            extent[0] = last
+            self.size -= last - start
+            if not extent[1]:
+                self.extents.remove(extent)
+
+    # Merge data at [offset, end) with the extents it overlaps or touches
+    def _merge(self, offset, end, data):
+        keep = []
+        touching = []
+        for extent in self.extents:
+            if extent[0] <= end and offset <= extent[0] + len(extent[1]):
+                touching.append(extent)
+            else:
+                keep.append(extent)
+        start = min([offset] + [extent[0] for extent in touching])
+        stop = max([end] + [extent[0] + len(extent[1]) for extent in touching])
+        merged = bytearray(stop - start)
+        for extent in touching:
+            merged[extent[0] - start:extent[0] - start + len(extent[1])] = extent[1]
+            self.size -= len(extent[1])
+        merged[offset - start:end - start] = data
+        self.size += len(merged)
+
+        extent = [start, merged]
+        keep.append(extent)
+        keep.sort(key=lambda extent: extent[0])
+        self.extents = keep
+        return extent
+
+    def _write(self, offset, data):
+        data = bytes(data)
+        while data:
+            written = pwrite(self.fh, data, offset)
+            self.written(self.path, offset, offset + written)
+            offset += written
+            data = data[written:]
+
+    # Write all of the buffer to the handle
+    def flush(self):
+        while self.extents:
+            offset, data = self.extents[0]
+            self._write(offset, data)
+            self.extents.pop(0)
+            self.size -= len(data)
+            self._settle()
+
+    # Forget whatever could not be written
+    def drop(self):
+        self.extents = []
+        self.size = 0
+        self._settle()